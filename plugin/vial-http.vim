@@ -8,4 +8,8 @@ augroup VialHttpSettings
     au BufNewFile __vial_http_hdr__ nnoremap <buffer> <silent> <c-j> :b __vial_http_req__<cr>
     au BufNewFile __vial_http_raw__ nnoremap <buffer> <silent> <c-k> :b __vial_http__<cr>
     au BufNewFile __vial_http_raw__ nnoremap <buffer> <silent> <c-j> :b __vial_http_hdr__<cr>
+    au CursorMoved __vial_http__,__vial_http_raw__
+        \ if get(b:, 'vial_http_paged') && line('.') + winheight(0) > line('$') | VialHttpMore | endif
 augroup END
+
+command! -range VialHttpRun VialHttpRunLines <line1> <line2>
@@ -3,6 +3,15 @@ import vial
 
 def init():
     vial.register_command('VialHttp', '.plugin.http')
+    vial.register_command('VialHttpCancel', '.plugin.cancel')
+    vial.register_command('VialHttpRunAll', '.plugin.run_all')
+    vial.register_command('VialHttpRunLines', '.plugin.run_lines', nargs='*')
+    vial.register_function('VialHttpPoll()', '.plugin.poll')
+    vial.register_command('VialHttpMore', '.plugin.more')
+    vial.register_command('VialHttpTimings', '.plugin.timings')
+    vial.register_command('VialHttpHistory', '.plugin.history', nargs='?')
+    vial.register_command('VialHttpHistoryShow', '.plugin.history_show')
+    vial.register_command('VialHttpBench', '.plugin.bench', nargs='*')
     vial.register_command('VialHttpCurl', '.plugin.curl')
     vial.register_command('VialHttpBasicAuth', '.plugin.basic_auth_cmd', nargs='?')
     vial.register_function('VialHttpBasicAuth()', '.plugin.basic_auth_func')
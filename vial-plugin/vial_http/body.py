@@ -0,0 +1,301 @@
+import os
+import zlib
+import atexit
+import shutil
+import tempfile
+from collections import deque
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 2 ** 16
+
+
+def send_file(cn, path):
+    """Sends file content into a connection
+
+    Uses zero-copy ``socket.sendfile`` when it's available and falls back
+    to chunked reads otherwise.
+    """
+    with open(path, 'rb') as f:
+        sendfile = getattr(cn.sock, 'sendfile', None)
+        if sendfile is not None:
+            collect = getattr(cn, 'collect', None)
+            if collect:
+                collect('<{} bytes from {}>'.format(os.fstat(f.fileno()).st_size,
+                                                   path).encode('utf-8'))
+            sendfile(f)
+            return
+
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            cn.send(data)
+
+
+class FileBody(object):
+    """Request body sent directly from a file"""
+    def __init__(self, path):
+        self.path = path
+        self.length = os.stat(path).st_size
+        self.headers = {'Content-Length': str(self.length)}
+
+    def __len__(self):
+        return self.length
+
+    def prefix(self, size):
+        with open(self.path, 'rb') as f:
+            return f.read(size)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def send_to(self, cn):
+        send_file(cn, self.path)
+
+
+class DeflateDecoder(object):
+    """Decodes zlib wrapped deflate stream or a raw one as some servers send"""
+    def __init__(self):
+        self.obj = zlib.decompressobj()
+        self.started = False
+
+    def decompress(self, data):
+        if not self.started and data:
+            self.started = True
+            try:
+                return self.obj.decompress(data)
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class BrotliDecoder(object):
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+        self.decompress = getattr(self.obj, 'process', None) or self.obj.decompress
+
+    def flush(self):
+        return b''
+
+
+class ZstdDecoder(object):
+    def __init__(self):
+        self.decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+
+    def flush(self):
+        return b''
+
+
+class GzipDecoder(object):
+    def __init__(self):
+        self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.decompress = self.obj.decompress
+        self.flush = self.obj.flush
+
+
+DECODERS = {'gzip': GzipDecoder, 'x-gzip': GzipDecoder, 'deflate': DeflateDecoder}
+if brotli:
+    DECODERS['br'] = BrotliDecoder
+if zstandard:
+    DECODERS['zstd'] = ZstdDecoder
+
+ACCEPT_ENCODING = ', '.join(r for r in ('gzip', 'deflate', 'br', 'zstd') if r in DECODERS)
+
+
+class MultiDecoder(object):
+    """Applies decoders for a list of content codings in reverse order"""
+    def __init__(self, decoders):
+        self.decoders = decoders
+
+    def decompress(self, data):
+        for d in self.decoders:
+            data = d.decompress(data)
+        return data
+
+    def flush(self):
+        data = b''
+        for d in self.decoders:
+            data = d.decompress(data) + d.flush()
+        return data
+
+
+def make_decoder(content_encoding):
+    """Returns incremental decoder for a Content-Encoding header value
+
+    Returns None for identity and unsupported encodings, such bodies
+    are kept as is.
+    """
+    names = [r.strip().lower() for r in (content_encoding or '').split(',')]
+    names = [r for r in names if r and r != 'identity']
+    if not names or any(r not in DECODERS for r in names):
+        return None
+
+    decoders = [DECODERS[r]() for r in reversed(names)]
+    if len(decoders) == 1:
+        return decoders[0]
+    return MultiDecoder(decoders)
+
+
+def iter_body(read, decoder=None, size=CHUNK_SIZE):
+    """Yields (decoded data, wire size) pairs of response body chunks
+
+    Decoded data is empty while a decoder buffers input.
+    """
+    while True:
+        data = read(size)
+        if not data:
+            data = decoder and decoder.flush()
+            if data:
+                yield data, 0
+            return
+
+        wire_size = len(data)
+        if decoder:
+            data = decoder.decompress(data)
+        yield data, wire_size
+
+
+class LineStream(object):
+    """Chunks of a streamed body split into complete lines
+
+    Reader thread appends chunks, main thread takes lines. Incomplete
+    tail waits for a next chunk.
+    """
+    def __init__(self):
+        self.chunks = deque()
+        self.tail = b''
+
+    def append(self, data):
+        self.chunks.append(data)
+
+    def clear(self):
+        """Drops pending data of a body which is going to be resent"""
+        self.chunks.clear()
+        self.tail = b''
+
+    def lines(self, final=False):
+        """Returns complete lines without line endings
+
+        `final` returns an incomplete tail too.
+        """
+        chunks = []
+        while self.chunks:
+            chunks.append(self.chunks.popleft())
+
+        lines = (self.tail + b''.join(chunks)).split(b'\n')
+        self.tail = lines.pop()
+        if final and self.tail:
+            lines.append(self.tail)
+            self.tail = b''
+
+        return [r[:-1] if r.endswith(b'\r') else r for r in lines]
+
+
+class ResponseBody(object):
+    """Response body kept in memory up to `spill_size` bytes
+
+    Larger bodies are written into a temporary file.
+    """
+    def __init__(self, spill_size):
+        self.spill_size = spill_size
+        self.chunks = []
+        self.size = 0
+        self.file = None
+        self.path = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file:
+            self.file.write(data)
+            return
+
+        self.chunks.append(data)
+        if self.size > self.spill_size:
+            self.file = tempfile.NamedTemporaryFile(prefix='vial-http-', delete=False)
+            self.path = self.file.name
+            spilled_files.add(self.path)
+            for chunk in self.chunks:
+                self.file.write(chunk)
+            self.chunks = []
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def getvalue(self):
+        """Returns body content or None for a spilled body"""
+        if not self.spilled:
+            return b''.join(self.chunks)
+
+    def read(self):
+        if not self.spilled:
+            return b''.join(self.chunks)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def discard(self):
+        if self.path:
+            remove_spilled(self.path)
+            self.path = None
+
+    def copy(self):
+        """Returns an independent body with the same content
+
+        Spilled file is hard linked if possible.
+        """
+        body = ResponseBody(self.spill_size)
+        body.size = self.size
+        if self.spilled:
+            f = tempfile.NamedTemporaryFile(prefix='vial-http-', delete=False)
+            f.close()
+            os.remove(f.name)
+            link_or_copy(self.path, f.name)
+            body.path = f.name
+            spilled_files.add(body.path)
+        else:
+            body.chunks = list(self.chunks)
+        return body
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+spilled_files = set()
+
+
+def remove_spilled(path):
+    spilled_files.discard(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def remove_all_spilled():
+    for path in list(spilled_files):
+        remove_spilled(path)
@@ -0,0 +1,177 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+CACHE_SIZE = 2 ** 27
+
+max_age_regex = re.compile(r'(?:^|,)\s*(?:s-)?max-age\s*=\s*"?(\d+)', re.I)
+
+
+def get_header(response, name):
+    value = response.getheader(name)
+    return value.strip() if value else None
+
+
+def get_expires(response, now):
+    """Returns freshness expiration time from Cache-Control or Expires
+
+    Responses without explicit freshness expire immediately and are
+    always revalidated.
+    """
+    cc = (get_header(response, 'Cache-Control') or '').lower()
+    if 'no-cache' in cc:
+        return now
+
+    m = max_age_regex.search(cc)
+    if m:
+        age = int(get_header(response, 'Age') or 0)
+        return now + int(m.group(1)) - age
+
+    expires = get_header(response, 'Expires')
+    date = get_header(response, 'Date')
+    if expires:
+        try:
+            expires = mktime_tz(parsedate_tz(expires))
+        except TypeError:
+            return now
+        if date:
+            try:
+                return now + expires - mktime_tz(parsedate_tz(date))
+            except TypeError:
+                pass
+        return expires
+
+    return now
+
+
+class CacheEntry(object):
+    def __init__(self, response, body, request_headers, now=None):
+        now = now or time.time()
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.headers = response.getheaders()
+        self.body = body
+        self.size = body.size
+        self.etag = get_header(response, 'ETag')
+        self.last_modified = get_header(response, 'Last-Modified')
+        self.expires = get_expires(response, now)
+        self.vary = [(r.strip().lower(), request_headers.get(r.strip()))
+                     for r in (get_header(response, 'Vary') or '').split(',') if r.strip()]
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name) == value for name, value in self.vary)
+
+    def add_validators(self, headers):
+        """Returns a copy of headers with conditional request validators"""
+        headers = headers.copy()
+        if self.etag and 'If-None-Match' not in headers:
+            headers.set('If-None-Match', self.etag)
+        if self.last_modified and 'If-Modified-Since' not in headers:
+            headers.set('If-Modified-Since', self.last_modified)
+        return headers
+
+    def refresh(self, response):
+        """Updates validators and freshness from 304 response"""
+        self.etag = get_header(response, 'ETag') or self.etag
+        self.last_modified = get_header(response, 'Last-Modified') or self.last_modified
+        self.expires = get_expires(response, time.time())
+
+
+def is_cacheable(response):
+    cc = (get_header(response, 'Cache-Control') or '').lower()
+    if response.status != 200 or 'no-store' in cc:
+        return False
+    return bool(get_header(response, 'ETag') or get_header(response, 'Last-Modified')
+                or max_age_regex.search(cc) or get_header(response, 'Expires'))
+
+
+class CachedResponse(object):
+    """Response served from :class:`ResponseCache`
+
+    Provides a part of HTTPResponse interface used by the plugin.
+    """
+    chunked = False
+    will_close = False
+
+    def __init__(self, entry):
+        self.status = entry.status
+        self.reason = entry.reason
+        self.msg = entry.msg
+        self.headers = entry.headers
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def getheaders(self):
+        return self.headers
+
+    def close(self):
+        pass
+
+
+class ResponseCache(object):
+    """LRU cache of GET responses limited by a total body size"""
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, request_headers):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+
+        if entry.matches(request_headers):
+            return entry
+
+    def put(self, key, response, body, request_headers):
+        if not is_cacheable(response) or body.size > self.size:
+            self.remove(key)
+            return
+
+        entry = CacheEntry(response, body.copy(), request_headers)
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.used -= old.size
+                evicted.append(old)
+            self.entries[key] = entry
+            self.used += entry.size
+            while self.used > self.size:
+                _, old = self.entries.popitem(last=False)
+                self.used -= old.size
+                evicted.append(old)
+
+        for r in evicted:
+            r.body.discard()
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.used -= entry.size
+        if entry:
+            entry.body.discard()
+
+    def clear(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+            self.used = 0
+        for r in entries:
+            r.body.discard()
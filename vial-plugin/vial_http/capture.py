@@ -0,0 +1,137 @@
+CAPTURE_HEAD = 2 ** 16
+CAPTURE_TAIL = 2 ** 12
+
+
+class Capture(object):
+    """Keeps the first `head` and the last `tail` bytes of a data stream
+
+    Both parts are preallocated, the tail is a ring buffer, so writes past
+    the head never grow memory and copy at most `tail` bytes per chunk.
+    """
+    def __init__(self, head=CAPTURE_HEAD, tail=CAPTURE_TAIL):
+        self.head = bytearray(head)
+        self.tail = bytearray(tail)
+        self.head_size = 0
+        self.tail_size = 0
+        self.tail_pos = 0
+        self.size = 0
+
+    def write(self, data):
+        size = len(data)
+        if not size:
+            return
+        self.size += size
+
+        data = memoryview(data)
+        free = len(self.head) - self.head_size
+        if free:
+            n = min(free, size)
+            self.head[self.head_size:self.head_size + n] = data[:n]
+            self.head_size += n
+            if n == size:
+                return
+            data = data[n:]
+            size -= n
+
+        tail = self.tail
+        tsize = len(tail)
+        if not tsize:
+            return
+
+        if size >= tsize:
+            tail[:] = data[size - tsize:]
+            self.tail_pos = 0
+            self.tail_size = tsize
+            return
+
+        pos = self.tail_pos
+        n = min(size, tsize - pos)
+        tail[pos:pos + n] = data[:n]
+        if n < size:
+            tail[:size - n] = data[n:]
+        self.tail_pos = (pos + size) % tsize
+        self.tail_size = min(tsize, self.tail_size + size)
+
+    @property
+    def skipped(self):
+        return self.size - self.head_size - self.tail_size
+
+    def getvalue(self):
+        result = bytes(self.head[:self.head_size])
+        if not self.tail_size:
+            return result
+
+        skipped = self.skipped
+        if skipped:
+            result += '\n...TRUNCATED {} bytes...\n'.format(skipped).encode('utf-8')
+
+        if self.tail_size < len(self.tail):
+            return result + bytes(self.tail[:self.tail_size])
+
+        pos = self.tail_pos
+        return result + bytes(self.tail[pos:]) + bytes(self.tail[:pos])
+
+
+class CaptureReader(object):
+    """File-like wrapper which writes everything read into a capture"""
+    def __init__(self, fp, capture):
+        self.fp = fp
+        self.capture = capture
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self.capture.write(data)
+        return data
+
+    def read1(self, *args):
+        data = self.fp.read1(*args)
+        self.capture.write(data)
+        return data
+
+    def readline(self, *args):
+        data = self.fp.readline(*args)
+        self.capture.write(data)
+        return data
+
+    def readinto(self, b):
+        n = self.fp.readinto(b)
+        if n:
+            self.capture.write(memoryview(b)[:n])
+        return n
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+def capture_connection(connection, head=CAPTURE_HEAD, tail=CAPTURE_TAIL):
+    """Captures raw bytes sent and received by a HTTP connection
+
+    Fresh `request_capture` and `response_capture` are set on every call,
+    patching itself is done once per connection.
+    """
+    connection.request_capture = Capture(head, tail)
+    connection.response_capture = Capture(head, tail)
+    if hasattr(connection, '_orig_send'):
+        return connection
+
+    connection._orig_send = send = connection.send
+    connection._orig_response_class = response_class = connection.response_class
+
+    def collect(data):
+        connection.request_capture.write(data)
+    connection.collect = collect
+
+    def capture_send(data):
+        connection.request_capture.write(data)
+        return send(data)
+    connection.send = capture_send
+
+    def make_response(sock, *args, **kwargs):
+        response = response_class(sock, *args, **kwargs)
+        response.fp = CaptureReader(response.fp, connection.response_capture)
+        return response
+    connection.response_class = make_response
+    return connection
@@ -0,0 +1,279 @@
+import os
+import ssl
+import time
+import errno
+import socket
+import select
+import threading
+
+from vial.compat import PY2
+
+if PY2:
+    import httplib
+else:
+    from http import client as httplib
+
+POOL_MAX_PER_HOST = 4
+POOL_IDLE_TIMEOUT = 60
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE')
+STALE_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+def ms(start, end):
+    return round((end - start) * 1000, 1)
+
+
+def connect_addrinfo(infos, timeout, source_address=None):
+    """Connects to a first available address from getaddrinfo result"""
+    error = None
+    for af, socktype, proto, _, sa in infos:
+        sock = None
+        try:
+            sock = socket.socket(af, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except socket.error as e:
+            error = e
+            if sock is not None:
+                sock.close()
+
+    raise error or socket.error('getaddrinfo returns an empty list')
+
+
+def unix_address(host):
+    """Returns unix socket address for ``unix:/path`` or ``unix:@abstract`` host"""
+    if not host or not host.startswith('unix:'):
+        return None
+    path = host[5:]
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+class TimedConnectMixin(object):
+    """Connects in separate steps to time each of them
+
+    :attr:`timings` holds ``dns``, ``tcp`` and ``tls`` durations in ms
+    of a last connect. Connects to :attr:`unix_socket` instead of
+    host and port if it's set.
+    """
+    timings = None
+    unix_socket = None
+
+    def unix_connect(self):
+        start = time.time()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            sock.connect(self.unix_socket)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.timings = {'tcp': ms(start, time.time())}
+
+    def tcp_connect(self):
+        if self.unix_socket:
+            return self.unix_connect()
+
+        start = time.time()
+        infos = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        self.sock = connect_addrinfo(infos, self.timeout, self.source_address)
+        self.timings = {'dns': ms(start, resolved), 'tcp': ms(resolved, time.time())}
+
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+
+        if self._tunnel_host:
+            self._tunnel()
+
+
+class TimedHTTPConnection(TimedConnectMixin, httplib.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        self.unix_socket = kwargs.pop('unix_socket', None)
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+
+    def connect(self):
+        self.tcp_connect()
+
+
+class TimedHTTPSConnection(TimedConnectMixin, httplib.HTTPSConnection):
+    """HTTPS connection resuming TLS sessions from an optional :class:`TLSCache`"""
+    session_reused = False
+
+    def __init__(self, *args, **kwargs):
+        self.tls_cache = kwargs.pop('tls_cache', None)
+        self.unix_socket = kwargs.pop('unix_socket', None)
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+
+    def connect(self):
+        self.tcp_connect()
+        start = time.time()
+
+        kwargs = {}
+        if self.tls_cache:
+            session = self.tls_cache.get_session(self._context, self.host, self.port)
+            if session is not None:
+                kwargs['session'] = session
+
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self._tunnel_host or self.host, **kwargs)
+        self.timings['tls'] = ms(start, time.time())
+        self.session_reused = getattr(self.sock, 'session_reused', False)
+
+    def save_session(self):
+        """Stores current TLS session for a next connection
+
+        TLS 1.3 servers send session tickets after a handshake, so it
+        should be called after a response is read.
+        """
+        session = getattr(self.sock, 'session', None)
+        if session is not None and self.tls_cache:
+            self.tls_cache.put_session(self._context, self.host, self.port, session)
+
+
+def make_ssl_context(certfile=None, keyfile=None, verify=False):
+    if verify:
+        ctx = ssl.create_default_context()
+        if certfile:
+            ctx.load_cert_chain(certfile, keyfile)
+        return ctx
+    return ssl._create_unverified_context(certfile=certfile, keyfile=keyfile)
+
+
+class TLSCache(object):
+    """Keeps SSL contexts and TLS sessions between connections
+
+    Contexts are keyed by (certfile, keyfile, verify) and recreated when
+    a modification time of cert or key file changes. Sessions are kept
+    per context and (host, port) to make abbreviated handshakes.
+    """
+    def __init__(self):
+        self.contexts = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_context(self, certfile=None, keyfile=None, verify=False):
+        key = certfile, keyfile, verify
+        mtimes = tuple(os.stat(r).st_mtime if r else None for r in (certfile, keyfile))
+        with self.lock:
+            ctx, ctx_mtimes = self.contexts.get(key, (None, None))
+            if ctx is not None and ctx_mtimes == mtimes:
+                return ctx
+
+        ctx = make_ssl_context(certfile, keyfile, verify)
+        with self.lock:
+            old = self.contexts.get(key)
+            if old:
+                self.sessions = {k: v for k, v in self.sessions.items()
+                                 if k[0] is not old[0]}
+            self.contexts[key] = ctx, mtimes
+        return ctx
+
+    def get_session(self, ctx, host, port):
+        with self.lock:
+            return self.sessions.get((ctx, host, port))
+
+    def put_session(self, ctx, host, port, session):
+        with self.lock:
+            self.sessions[(ctx, host, port)] = session
+
+    def clear(self):
+        with self.lock:
+            self.contexts.clear()
+            self.sessions.clear()
+
+
+def is_dropped(cn):
+    """Checks idle keep-alive connection was closed by server
+
+    Idle socket must not have any pending data, readable state means
+    EOF or garbage so connection can't be reused.
+    """
+    sock = cn.sock
+    if sock is None:
+        return True
+
+    try:
+        r, _, _ = select.select([sock], [], [], 0)
+    except (ValueError, select.error):
+        return True
+
+    return bool(r)
+
+
+class StaleConnection(Exception):
+    """Reused connection was closed by server before a response"""
+
+
+def is_stale_error(error):
+    """Checks error means a server closed an idle keep-alive connection
+
+    It's a broken pipe or a reset on write and an empty status line.
+    Timeouts are real errors, a server can be processing a request.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and getattr(error, 'errno', None) in STALE_ERRNOS
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections between requests
+
+    Connections are keyed by a tuple describing connection target
+    (scheme, host, port, client cert, ...). Pool owns only idle
+    connections, active ones belong to a caller until :meth:`put`.
+    """
+    def __init__(self, max_per_host=POOL_MAX_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key)
+            while conns:
+                cn, ts = conns.pop()
+                if now - ts < self.idle_timeout and not is_dropped(cn):
+                    return cn
+                cn.close()
+        return None
+
+    def put(self, key, cn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            conns.append((cn, time.time()))
+            while len(conns) > self.max_per_host:
+                conns.pop(0)[0].close()
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for key, conns in list(self.idle.items()):
+                alive = []
+                for cn, ts in conns:
+                    if now - ts < self.idle_timeout:
+                        alive.append((cn, ts))
+                    else:
+                        cn.close()
+                if alive:
+                    self.idle[key] = alive
+                else:
+                    del self.idle[key]
+
+    def clear(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for cn, _ in conns:
+                    cn.close()
+            self.idle.clear()
@@ -0,0 +1,108 @@
+import time
+import threading
+
+from .util import parse_request_line, render_template, header_regex, PrepareException
+
+PRODUCER_TTL = 600
+
+
+def find_producer(doc, name):
+    """Returns first line of a request with ``Vial-Name: name`` or None"""
+    for first, _ in doc.requests:
+        raw = parse_request_line(doc.lines[first])
+        if raw and any(k.lower() == 'vial-name' and v == name
+                       for k, v in raw['headers'].items()):
+            return first
+
+
+def apply_header_lines(text, headers):
+    """Sets headers from ``Name: value`` lines, ``+Name`` adds a header"""
+    for line in text.splitlines():
+        name, sep, value = line.partition(':')
+        name = name.strip()
+        if not sep or not header_regex.match(name):
+            continue
+        if name.startswith('+'):
+            headers.add(name[1:], value.strip())
+        else:
+            headers.set(name, value.strip())
+
+
+def resolve_producers(cache, doc, file, depends, headers, states, parse):
+    """Applies cached captures of producers in `depends` to headers
+
+    Cached producers are added to `states` as (name, 'cached'). Returns
+    (name, key, args, templates, tlist) of producers which should be
+    executed before a request, `parse` prepares a request at a doc line.
+    """
+    producers = []
+    for name in depends.split(','):
+        name = name.strip()
+        if not name:
+            continue
+
+        key = file, name
+        entry = cache.get(key)
+        if entry is not None:
+            entry.apply(headers)
+            states.append((name, 'cached'))
+            continue
+
+        line = find_producer(doc, name)
+        if line is None:
+            raise PrepareException('Producer request {} not found'.format(name))
+        (pheaders, templates, method, url, query, body,
+         tlist, _) = parse(doc, line)
+        if 'Vial-Depends' in pheaders:
+            raise PrepareException('Producer request {} can\'t depend on '
+                                   'other producers'.format(name))
+        producers.append((name, key, (method, url, query, body, pheaders, line),
+                          templates, tlist))
+
+    return producers
+
+
+class Producer(object):
+    """Header lines rendered from templates of a named request"""
+    def __init__(self, text, expires):
+        self.text = text
+        self.expires = expires
+
+    def render(self):
+        return self.text
+
+    def apply(self, headers):
+        apply_header_lines(self.text, headers)
+
+
+def render_producer(ctx, templates, tlist):
+    """Renders producer templates, missing ones are skipped"""
+    return '\n'.join(render_template(templates[t], **ctx)
+                     for t in tlist if t in templates)
+
+
+class ProducerCache(object):
+    """Rendered header lines of producer requests keyed by (file, name) with a TTL
+
+    Templates are rendered on put while a response body is still
+    available, spilled bodies can be removed afterwards.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self.entries[key]
+                entry = None
+            return entry
+
+    def put(self, key, ctx, templates, tlist, ttl=PRODUCER_TTL, now=None):
+        entry = Producer(render_producer(ctx, templates, tlist),
+                         (now or time.time()) + ttl)
+        with self.lock:
+            self.entries[key] = entry
+        return entry
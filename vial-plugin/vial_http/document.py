@@ -0,0 +1,152 @@
+from bisect import bisect_left, bisect_right
+
+from .util import (Headers, iter_headers_and_templates, iter_heredocs,
+                   iter_requests, find_block)
+
+INF = float('inf')
+
+
+def covers(spans, line):
+    """Checks any of sorted non-overlapping (start, end, ...) spans contains line"""
+    idx = bisect_right(spans, (line, INF)) - 1
+    return idx >= 0 and spans[idx][0] <= line <= spans[idx][1]
+
+
+class Document(object):
+    """Parsed content of a .http buffer
+
+    Keeps header lines, templates, heredocs and request blocks collected
+    by a single linear pass. Lookups by a line number use bisect and don't
+    depend on a document size. :meth:`update` reparses only lines after
+    a last clean block boundary before a first changed line.
+    """
+    def __init__(self, lines):
+        self.lines = []
+        self.header_lines = []
+        self.headers = []
+        self.templates = []
+        self.heredocs = []
+        self.unterminated = []
+        self.requests = []
+        self.skipped = []
+        self.snapshot = 0, Headers()
+        self.update(lines)
+
+    def update(self, lines, changed=None):
+        """Reparses document with new lines
+
+        `changed` is a first changed line if it's known, otherwise it's
+        found by comparing old and new lines.
+        """
+        old = self.lines
+        if changed is None:
+            size = min(len(old), len(lines))
+            changed = 0
+            while changed < size and old[changed] == lines[changed]:
+                changed += 1
+
+            if changed == len(old) == len(lines):
+                return
+
+        start = self.restart_point(changed)
+        self.truncate(start)
+        self.lines = lines
+        self.parse(start)
+
+    def restart_point(self, line):
+        """Returns an empty line before `line` outside of any block
+
+        Each parser has own rules for block ends, so a line should be
+        outside of blocks of all of them, including template blocks
+        skipped by :func:`iter_requests`.
+        """
+        lines = self.lines
+        line = min([line, len(lines)] + self.unterminated[:1])
+        while line > 0:
+            line -= 1
+            if (not lines[line].strip() and not covers(self.templates, line)
+                    and not covers(self.heredocs, line)
+                    and not covers(self.requests, line)
+                    and not covers(self.skipped, line)):
+                return line
+        return 0
+
+    def truncate(self, line):
+        idx = bisect_left(self.header_lines, line)
+        del self.header_lines[idx:]
+        del self.headers[idx:]
+        if self.snapshot[0] > idx:
+            self.snapshot = 0, Headers()
+
+        for spans in (self.templates, self.heredocs, self.requests, self.skipped):
+            del spans[bisect_left(spans, (line,)):]
+        del self.unterminated[bisect_left(self.unterminated, line):]
+
+    def parse(self, start):
+        lines = self.lines
+        for kind, first, last, name, value in iter_headers_and_templates(lines, start):
+            if kind == 'template':
+                self.templates.append((first, last, name, value))
+            else:
+                self.header_lines.append(first)
+                self.headers.append((kind, name, value))
+
+        self.heredocs.extend(iter_heredocs(lines, start, self.unterminated))
+        self.requests.extend(iter_requests(lines, start, self.skipped))
+
+    def get_headers_and_templates(self, line):
+        idx = bisect_left(self.header_lines, line)
+        start, headers = self.snapshot
+        if start > idx:
+            start, headers = 0, Headers()
+
+        headers = headers.copy()
+        for kind, name, value in self.headers[start:idx]:
+            if kind == 'add':
+                headers.add(name, value)
+            else:
+                headers.set(name, value)
+        self.snapshot = idx, headers
+        headers = headers.copy()
+
+        templates = {}
+        for first, last, name, body in self.templates:
+            if first >= line:
+                break
+            if last >= line:
+                _, _, _, name, body = next(iter_headers_and_templates(self.lines, first, line))
+            templates[name] = body
+
+        return headers, templates
+
+    def find_request(self, line):
+        idx = bisect_right(self.heredocs, (line, INF)) - 1
+        if idx >= 0:
+            start, end, l, body = self.heredocs[idx]
+            if start <= line <= end:
+                return l, body, end
+
+        return find_block(self.lines, line)
+
+    def locate_request(self, line, block):
+        """Returns a first line of a request with `block` lines or None
+
+        Used to find a request again after edits, the nearest to
+        `line` one is returned if there are several equal requests.
+        """
+        size = len(block)
+        if self.lines[line:line + size] == block:
+            return line
+
+        found = [first for first, _ in self.requests
+                 if self.lines[first:first + size] == block]
+        if found:
+            return min(found, key=lambda first: abs(first - line))
+
+    def find_requests(self, start=0, end=None):
+        if end is None:
+            end = len(self.lines) - 1
+
+        first = max(0, bisect_right(self.requests, (start, INF)) - 1)
+        last = bisect_right(self.requests, (end, INF))
+        return [r for r in self.requests[first:last] if r[1] >= start]
@@ -0,0 +1,106 @@
+import os
+import re
+import time
+
+from .body import CHUNK_SIZE
+from .connection import httplib
+
+content_range_regex = re.compile(r'^\s*bytes\s+(?:(\d+)-\d*|\*)\s*(?:/\s*(\d+|\*))?')
+
+
+class RestartDownload(Exception):
+    """Interrupted download can't be resumed, its ``.part`` file is removed"""
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def parse_content_range(value):
+    """Returns (first byte, complete length) of a Content-Range value
+
+    Unknown values are None, returns None for invalid headers.
+    """
+    m = content_range_regex.match(value or '')
+    if not m:
+        return None
+    first, total = m.groups()
+    return (None if first is None else int(first),
+            None if total in (None, '*') else int(total))
+
+
+class Download(object):
+    """Writes a response body as is into `path`
+
+    Body goes into a ``.part`` file first which is renamed after
+    completion. Partial content response appends to an existing
+    ``.part`` file. :attr:`size` grows while a body is read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.part = path + '.part'
+        self.offset = self.size = 0
+        self.total = None
+        self.start = None
+
+    def range(self):
+        """Returns Range header value to resume an interrupted download or None"""
+        offset = file_size(self.part)
+        if offset:
+            return 'bytes={}-'.format(offset)
+
+    def accepts(self, response):
+        return response.status in (200, 206, 416)
+
+    def save(self, response, chunk_size=CHUNK_SIZE):
+        if response.status == 416:
+            return self._complete(response)
+
+        offset = 0
+        if response.status == 206:
+            crange = parse_content_range(response.getheader('Content-Range'))
+            offset = file_size(self.part)
+            if not crange or crange[0] != offset:
+                raise httplib.HTTPException('Unexpected Content-Range: {}'.format(
+                    response.getheader('Content-Range')))
+
+        length = response.getheader('Content-Length')
+        self.offset = self.size = offset
+        self.total = offset + int(length) if length else None
+        self.start = time.time()
+
+        with open(self.part, 'ab' if offset else 'wb') as f:
+            while True:
+                data = response.read(chunk_size)
+                if not data:
+                    break
+                f.write(data)
+                self.size += len(data)
+
+        if response.length:
+            raise httplib.IncompleteRead(b'', response.length)
+
+        os.rename(self.part, self.path)
+
+    def _complete(self, response):
+        """Handles 416 Range Not Satisfiable for a resumed download
+
+        Server answers so if ``.part`` file is already complete. It's
+        renamed if its size matches a complete length from Content-Range,
+        otherwise it's removed and RestartDownload is raised.
+        """
+        response.read()
+        crange = parse_content_range(response.getheader('Content-Range'))
+        size = file_size(self.part)
+        if size and crange and crange[1] == size:
+            self.offset = self.size = self.total = size
+            self.start = time.time()
+            os.rename(self.part, self.path)
+            return
+
+        if os.path.exists(self.part):
+            os.remove(self.part)
+        raise RestartDownload()
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+
+from .body import link_or_copy
+
+HISTORY_BODY_SIZE = 2 ** 16
+HISTORY_MAX_SIZE = 2 ** 28
+HISTORY_MAX_AGE = 30 * 24 * 3600
+HISTORY_EVICT_EVERY = 1000
+REDACTED_HEADERS = ('authorization', 'proxy-authorization', 'cookie', 'set-cookie')
+REDACTED = '<redacted>'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    file TEXT,
+    line INTEGER,
+    method TEXT,
+    url TEXT,
+    status INTEGER,
+    reason TEXT,
+    request BLOB,
+    headers TEXT,
+    body BLOB,
+    body_path TEXT,
+    size INTEGER,
+    stored INTEGER,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_url ON requests (url, time);
+CREATE INDEX IF NOT EXISTS requests_time ON requests (time);
+CREATE INDEX IF NOT EXISTS requests_source ON requests (file, line, time);
+'''
+
+FIELDS = ('id', 'time', 'file', 'line', 'method', 'url', 'status', 'reason',
+          'size', 'timings')
+
+
+def redact_headers(headers):
+    """Returns (name, value) pairs with values of credential headers replaced"""
+    return [(k, REDACTED if k.lower() in REDACTED_HEADERS else v) for k, v in headers]
+
+
+def redact_request(raw):
+    """Replaces values of credential headers in a raw request head"""
+    head, sep, body = raw.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    for i, line in enumerate(lines[1:], 1):
+        name, colon, _ = line.partition(b':')
+        if colon and name.strip().lower().decode('latin1') in REDACTED_HEADERS:
+            lines[i] = name + b': ' + REDACTED.encode('latin1')
+    return b'\r\n'.join(lines) + sep + body
+
+
+def default_path():
+    root = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(root, 'vial-http', 'history.sqlite')
+
+
+class History(object):
+    """Append-only store of executed requests in a sqlite database
+
+    Bodies up to `body_size` are kept in a database, larger ones are
+    saved into files next to it and referenced by a path. Values of
+    credential headers are not stored. Oldest records above `max_size`
+    bytes of stored data are evicted by additions, a total size is kept
+    in memory. Records older than `max_age` seconds are evicted by
+    a first addition and after every HISTORY_EVICT_EVERY ones, opening
+    a database doesn't scan it.
+    """
+    def __init__(self, path=None, body_size=HISTORY_BODY_SIZE,
+                 max_size=HISTORY_MAX_SIZE, max_age=HISTORY_MAX_AGE):
+        self.path = path or default_path()
+        self.body_size = body_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.added = 0
+        self.total = None
+        self._db = None
+        self.lock = threading.RLock()
+
+    @property
+    def bodies_dir(self):
+        return os.path.join(os.path.dirname(self.path), 'bodies')
+
+    @property
+    def db(self):
+        with self.lock:
+            if self._db is None:
+                if not os.path.isdir(self.bodies_dir):
+                    os.makedirs(self.bodies_dir)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('PRAGMA synchronous=NORMAL')
+                db.executescript(SCHEMA)
+                self._db = db
+            return self._db
+
+    def stored_total(self):
+        """Returns size of stored data, it's counted once per open"""
+        with self.lock:
+            if self.total is None:
+                self.total = self.db.execute(
+                    'SELECT COALESCE(SUM(stored), 0) FROM requests').fetchone()[0]
+            return self.total
+
+    def add(self, rctx, file=None, line=None):
+        """Records a finished request context, returns record id"""
+        db = self.db
+        body = rctx.body
+        body_data = body_path = None
+        if rctx.size > self.body_size:
+            fd, body_path = tempfile.mkstemp(prefix='body-', dir=self.bodies_dir)
+            os.close(fd)
+            if body.spilled:
+                os.remove(body_path)
+                link_or_copy(body.path, body_path)
+            else:
+                with open(body_path, 'wb') as f:
+                    f.write(body.getvalue())
+        else:
+            body_data = sqlite3.Binary(body.read())
+
+        request = redact_request(rctx.raw_request)[:self.body_size]
+        headers = json.dumps(redact_headers(rctx.response.getheaders()))
+        timings = json.dumps(rctx.timings)
+        _, url = rctx.response.request
+
+        stored = rctx.size + len(request) + len(headers)
+        with self.lock:
+            total = self.stored_total()
+            cur = db.execute(
+                'INSERT INTO requests (time, file, line, method, url, status, reason,'
+                ' request, headers, body, body_path, size, stored, timings)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (time.time(), file, line, rctx.method, url, rctx.response.status,
+                 rctx.response.reason, sqlite3.Binary(request), headers, body_data,
+                 body_path, rctx.size, stored, timings))
+            db.commit()
+            self.total = total + stored
+            self.added += 1
+            if self.added % HISTORY_EVICT_EVERY == 1:
+                self.evict()
+            elif self.total > self.max_size:
+                self.evict_size()
+            return cur.lastrowid
+
+    def _select(self, where, params, limit):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT {} FROM requests {} ORDER BY time DESC LIMIT ?'.format(
+                    ', '.join(FIELDS), where), params + (limit,)).fetchall()
+
+        result = []
+        for row in rows:
+            r = dict(zip(FIELDS, row))
+            r['timings'] = json.loads(r['timings'] or '{}')
+            result.append(r)
+        return result
+
+    def latest(self, limit=200):
+        return self._select('', (), limit)
+
+    def for_source(self, file, line, limit=200):
+        return self._select('WHERE file = ? AND line = ?', (file, line), limit)
+
+    def for_url(self, prefix, limit=200):
+        return self._select('WHERE url >= ? AND url < ?',
+                            (prefix, prefix + u'\uffff'), limit)
+
+    def get(self, id):
+        """Returns full record with request, headers and body or None"""
+        with self.lock:
+            cur = self.db.execute('SELECT * FROM requests WHERE id = ?', (id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            r = dict(zip([d[0] for d in cur.description], row))
+
+        r['timings'] = json.loads(r['timings'] or '{}')
+        r['headers'] = json.loads(r['headers'] or '[]')
+        for name in ('request', 'body'):
+            if r[name] is not None:
+                r[name] = bytes(r[name])
+        return r
+
+    def evict(self, now=None):
+        """Removes records older than `max_age` and oldest ones above `max_size`"""
+        now = now or time.time()
+        self._delete('time < ?', (now - self.max_age,))
+        self.evict_size()
+
+    def evict_size(self):
+        """Removes oldest records until stored data fits into `max_size`
+
+        Only evicted rows are read.
+        """
+        with self.lock:
+            excess = self.stored_total() - self.max_size
+            if excess <= 0:
+                return
+
+            cutoff = None
+            for id, stored in self.db.execute('SELECT id, stored FROM requests ORDER BY id'):
+                cutoff = id
+                excess -= stored
+                if excess <= 0:
+                    break
+
+        if cutoff is not None:
+            self._delete('id <= ?', (cutoff,))
+
+    def _delete(self, cond, params):
+        with self.lock:
+            db = self.db
+            total = self.stored_total()
+            stored, = db.execute(
+                'SELECT COALESCE(SUM(stored), 0) FROM requests WHERE ' + cond, params).fetchone()
+            if not stored:
+                return
+
+            paths = [r[0] for r in db.execute(
+                'SELECT body_path FROM requests WHERE ({}) AND body_path IS NOT NULL'.format(cond),
+                params)]
+            db.execute('DELETE FROM requests WHERE ' + cond, params)
+            db.commit()
+            self.total = total - stored
+
+        for p in paths:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self.total = None
@@ -1,12 +1,103 @@
+import os.path
 import mimetypes
 import random
 import string
 
 from vial.compat import bstr
 
+from .body import CHUNK_SIZE, send_file
+
 _BOUNDARY_CHARS = string.digits + string.ascii_letters
 
 
+class FilePart(object):
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+
+class MultipartBody(object):
+    r"""Streaming multipart/form-data body.
+
+    Unlike :func:`encode_multipart` file values can have 'path' key instead
+    of 'content', such files are read from disk in chunks during sending
+    and never loaded into memory. Content length is computed from file sizes.
+
+    >>> body = MultipartBody([('FIELD', 'VALUE')], [], boundary=b'BOUNDARY')
+    >>> len(body), b''.join(body)
+    (81, b'--BOUNDARY\r\nContent-Disposition: form-data; name="FIELD"\r\n\r\nVALUE\r\n--BOUNDARY--\r\n')
+    """
+    def __init__(self, fields, files, boundary=None):
+        def escape_quote(s):
+            return bstr(s).replace(b'"', b'\\"')
+
+        if boundary is None:
+            boundary = ''.join(random.choice(_BOUNDARY_CHARS) for i in range(30)).encode('latin1')
+
+        self.fields = fields
+        self.files = files
+        self.parts = parts = []
+
+        for name, value in fields:
+            parts.append(b'\r\n'.join((
+                b'--%s' % boundary,
+                b'Content-Disposition: form-data; name="%s"' % escape_quote(name),
+                b'',
+                bstr(value, 'utf-8'),
+                b'',
+            )))
+
+        for name, value in files:
+            filename = value['filename']
+            if 'mimetype' in value:
+                mimetype = value['mimetype']
+            else:
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            parts.append(b'\r\n'.join((
+                b'--%s' % boundary,
+                b'Content-Disposition: form-data; name="%s"; filename="%s"' % (
+                        escape_quote(name), escape_quote(filename)),
+                b'Content-Type: %s' % (bstr(mimetype)),
+                b'',
+                b'',
+            )))
+            if 'path' in value:
+                parts.append(FilePart(value['path']))
+            else:
+                parts.append(value['content'])
+            parts.append(b'\r\n')
+
+        parts.append(b'--%s--\r\n' % boundary)
+
+        self.length = sum(r.size if isinstance(r, FilePart) else len(r) for r in parts)
+        self.headers = {
+            'Content-Type': 'multipart/form-data; boundary=%s' % boundary.decode('latin1'),
+            'Content-Length': str(self.length),
+        }
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, FilePart):
+                with open(part.path, 'rb') as f:
+                    while True:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        yield data
+            else:
+                yield part
+
+    def send_to(self, cn):
+        for part in self.parts:
+            if isinstance(part, FilePart):
+                send_file(cn, part.path)
+            else:
+                cn.send(part)
+
+
 def encode_multipart(fields, files, boundary=None):
     r"""Encode dict of form fields and dict of files as multipart/form-data.
     Return tuple of (body_string, headers_dict). Each value in files is a dict
@@ -33,45 +124,6 @@ def encode_multipart(fields, files, boundary=None):
     >>> len(body)
     193
     """
-    def escape_quote(s):
-        return bstr(s).replace(b'"', b'\\"')
-
-    if boundary is None:
-        boundary = ''.join(random.choice(_BOUNDARY_CHARS) for i in range(30)).encode('latin1')
-    lines = []
-
-    for name, value in fields:
-        lines.extend((
-            b'--%s' % boundary,
-            b'Content-Disposition: form-data; name="%s"' % escape_quote(name),
-            b'',
-            bstr(value, 'utf-8'),
-        ))
-
-    for name, value in files:
-        filename = value['filename']
-        if 'mimetype' in value:
-            mimetype = value['mimetype']
-        else:
-            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        lines.extend((
-            b'--%s' % boundary,
-            b'Content-Disposition: form-data; name="%s"; filename="%s"' % (
-                    escape_quote(name), escape_quote(filename)),
-            b'Content-Type: %s' % (bstr(mimetype)),
-            b'',
-            value['content'],
-        ))
-
-    lines.extend((
-        b'--%s--' % boundary,
-        b'',
-    ))
-    body = b'\r\n'.join(lines)
-
-    headers = {
-        b'Content-Type': b'multipart/form-data; boundary=%s' % boundary,
-        b'Content-Length': bstr(str(len(body))),
-    }
-
-    return (body, headers)
+    body = MultipartBody(fields, files, boundary)
+    headers = {bstr(k): bstr(v) for k, v in body.headers.items()}
+    return (b''.join(body), headers)
@@ -0,0 +1,93 @@
+import mmap
+from collections import deque
+
+from vial.compat import bstr
+
+PAGE_LINES = 1000
+PAGE_SIZE = 2 ** 20
+
+pagers = {}
+
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Pager(object):
+    """Lazily appends lines of a file into a buffer
+
+    Lines are read from a memory map by pages of PAGE_LINES lines
+    (but not more than PAGE_SIZE bytes) on :func:`more` calls.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = map_file(path)
+        self.pos = 0
+
+    @property
+    def done(self):
+        return self.pos >= len(self.mm)
+
+    def next_lines(self):
+        mm = self.mm
+        limit = min(len(mm), self.pos + PAGE_SIZE)
+        end = self.pos
+        for _ in range(PAGE_LINES):
+            end = mm.find(b'\n', end, limit)
+            if end < 0:
+                end = limit
+                break
+            end += 1
+
+        data = mm[self.pos:end]
+        self.pos = end
+        return data.splitlines()
+
+    def attach(self, buf):
+        pagers.pop(buf.number, None)
+        buf[:] = self.next_lines()
+        if not self.done:
+            pagers[buf.number] = self
+        buf.vars['vial_http_paged'] = int(not self.done)
+
+
+class StreamPager(Pager):
+    """Pager over an iterator of byte chunks
+
+    Chunks are pulled only until a next page is complete, so expensive
+    sources like :func:`iter_pretty_json` are processed on demand.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.tail = b''
+        self.lines = deque()
+        self.finished = False
+
+    @property
+    def done(self):
+        return self.finished and not self.lines
+
+    def next_lines(self):
+        lines = self.lines
+        while len(lines) < PAGE_LINES and not self.finished:
+            try:
+                chunk = next(self.chunks, None)
+            except Exception as e:
+                chunk = None
+                self.tail += bstr('\nERROR: {}'.format(e), 'utf-8')
+
+            if chunk is None:
+                self.finished = True
+                if self.tail:
+                    lines.extend(self.tail.split(b'\n'))
+                break
+
+            parts = (self.tail + chunk).split(b'\n')
+            self.tail = parts.pop()
+            lines.extend(parts)
+            if len(self.tail) > PAGE_SIZE:
+                lines.append(self.tail)
+                self.tail = b''
+
+        return [lines.popleft() for _ in range(min(PAGE_LINES, len(lines)))]
@@ -1,11 +1,23 @@
+import os
 import json
+import hashlib
 import time
+import socket
+import sqlite3
+import datetime
+from collections import Counter
+from functools import partial
 
 try:
     from shlex import quote as cmd_quote
 except ImportError:
     from pipes import quote as cmd_quote
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from vial import vfunc, vim
 from vial.utils import focus_window
 from vial.helpers import echoerr
@@ -23,13 +35,52 @@ else:
     from urllib import parse as urlparse
     from io import BytesIO as StringIO
 
-from .util import (get_headers_and_templates, send_collector, prepare_request,
+from .util import (prepare_request,
                    PrepareException, render_template, Headers, pretty_xml,
-                   get_connection_settings, CookieJar)
+                   get_connection_settings, CookieJar, is_true, lazy,
+                   percentile, histogram, iter_pretty_json, iter_pretty_xml,
+                   parse_hosts, pop_control_headers)
+from .connection import (ConnectionPool, TimedHTTPConnection,
+                         TimedHTTPSConnection, TLSCache, ms, unix_address,
+                         StaleConnection, is_stale_error, IDEMPOTENT_METHODS)
+from .worker import Job, JobList, CancelledError, run_parallel
+from .document import Document
+from .multipart import MultipartBody
+from .body import (FileBody, ResponseBody, LineStream, make_decoder, iter_body,
+                   ACCEPT_ENCODING)
+from .download import Download, RestartDownload
+from .pager import Pager, StreamPager, map_file, pagers
+from .history import History
+from .cache import ResponseCache, CachedResponse
+from .capture import capture_connection, CAPTURE_HEAD, CAPTURE_TAIL
+from .session import get_session, session_name
+from .profiler import Profiler, profile_mode
+from .depends import ProducerCache, resolve_producers, PRODUCER_TTL
 
 CONNECT_TIMEOUT = 5
 READ_TIMEOUT = 30
 XML_FORMAT_SIZE_THRESHOLD = 2 ** 20
+JSON_FORMAT_SIZE_THRESHOLD = 2 ** 20
+POLL_INTERVAL = 50
+BODY_CHUNK_SIZE = 2 ** 16
+SPILL_SIZE = 2 ** 22
+SPILL_KEEP = 4
+BATCH_CONCURRENCY = 8
+BENCH_REQUESTS = 100
+BENCH_CONCURRENCY = 10
+FANOUT_CONCURRENCY = 32
+TIMING_PHASES = ('dns', 'tcp', 'tls', 'write', 'ttfb', 'transfer')
+
+connection_pool = ConnectionPool()
+tls_cache = TLSCache()
+request_history = History()
+response_cache = ResponseCache()
+producer_cache = ProducerCache()
+jobs = JobList()
+documents = {}
+spilled_bodies = []
+poll_timer = [None]
+last_response = [None]
 
 
 def sizeof_fmt(num, suffix='b'):
@@ -43,7 +94,60 @@ def sizeof_fmt(num, suffix='b'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def format_json(content):
+def format_download(download):
+    """Download progress for a status line"""
+    size = download.size
+    elapsed = time.time() - download.start
+    speed = (size - download.offset) / elapsed if elapsed > 0 else 0
+    if download.total:
+        progress = '{} of {} {}%'.format(sizeof_fmt(size), sizeof_fmt(download.total),
+                                          size * 100 // download.total)
+    else:
+        progress = sizeof_fmt(size)
+    return '{} {}/s'.format(progress, sizeof_fmt(speed))
+
+
+def load_json(content):
+    try:
+        return json.loads(content)
+    except:
+        return {}
+
+
+def format_size(rctx):
+    """Decoded body size with a wire size for compressed bodies"""
+    if rctx.encoding:
+        return '{} ({} {})'.format(sizeof_fmt(rctx.size),
+                                   sizeof_fmt(rctx.wire_size), rctx.encoding)
+    return sizeof_fmt(rctx.size)
+
+
+def format_timings(timings):
+    """Short phases summary for a status line, skipped phases are omitted"""
+    return ' '.join('{} {:.0f}'.format(p, timings[p])
+                    for p in TIMING_PHASES if timings.get(p) is not None)
+
+
+def format_json(content, fast=False):
+    """Returns (content, 'json', jdata) for json body
+
+    Bodies above JSON_FORMAT_SIZE_THRESHOLD are reindented on token level
+    and returned as lazy content, jdata is parsed only on demand. `fast`
+    enables orjson if it's installed.
+    """
+    if fast and orjson:
+        try:
+            jdata = orjson.loads(content)
+        except ValueError:
+            pass
+        else:
+            content = orjson.dumps(jdata, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+            return content, 'json', jdata
+
+    if len(content) > JSON_FORMAT_SIZE_THRESHOLD:
+        return (lazy(lambda: b''.join(iter_pretty_json(content))), 'json',
+                lazy(lambda: load_json(content)))
+
     try:
         jdata = json.loads(content)
     except:
@@ -54,33 +158,96 @@ def format_json(content):
     return content, 'json', jdata
 
 
+def try_pretty_xml(content):
+    buf = StringIO()
+    try:
+        pretty_xml(content, buf)
+    except:
+        return content
+    return buf.getvalue()
+
+
 def format_xml(content):
-    if len(content) < XML_FORMAT_SIZE_THRESHOLD:
-        buf = StringIO()
-        try:
-            pretty_xml(content, buf)
-        except:
-            pass
-        else:
-            content = buf.getvalue()
-    return content, 'xml', {}
+    """Returns (content, 'xml', {}) for xml body
+
+    Bodies above XML_FORMAT_SIZE_THRESHOLD are returned as lazy content
+    and formatted by pages with :class:`StreamPager`.
+    """
+    if content[:64].lstrip()[:1] != b'<':
+        return content, 'xml', {}
+
+    if len(content) > XML_FORMAT_SIZE_THRESHOLD:
+        return lazy(lambda: try_pretty_xml(content)), 'xml', {}
+
+    return try_pretty_xml(content), 'xml', {}
+
+
+def is_xml(content_type):
+    return content_type in ('application/xml', 'text/xml') or content_type.endswith('+xml')
 
 
-def format_content(content_type, content):
+def format_content(content_type, content, fast_json=False):
     if content_type == 'application/json':
-        return format_json(content)
+        return format_json(content, fast_json)
     elif content_type == 'text/html':
         return content, 'html', {}
-    elif content_type in ('application/xml', 'text/xml', 'text/plain') or content_type.endswith('+xml'):
+    elif is_xml(content_type) or content_type == 'text/plain':
         return format_xml(content)
 
     return content, 'text', {}
 
 
+def get_content_type(response):
+    if PY2:
+        return response.msg.gettype()
+    return response.msg.get_content_type()
+
+
 class RequestContext(object):
+    cn = None
+    body = None
+    cancelled = False
+    streaming = False
+    fast_json = False
+    encoding = None
+    tls_resumed = False
+    source = None
+    history_id = None
+    use_cache = False
+    cache_state = None
+    session = None
+    profiler = None
+    producer = None
+    name = None
+    ttl = PRODUCER_TTL
+    download = None
+    downloaded = None
+    size = wire_size = 0
+    raw_request = raw_response = b''
+    record = False
+    capture_head = CAPTURE_HEAD
+    capture_tail = CAPTURE_TAIL
+    stream = None
+
+    def __init__(self):
+        self.producers = []
+
+    def cancel(self):
+        self.cancelled = True
+        if self.producer:
+            self.producer.cancel()
+        cn = self.cn
+        if cn and cn.sock:
+            try:
+                cn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
     def _request(self, method, url, query, body, headers):
         (host, port), u = get_connection_settings(url, headers)
         headers.set('Host', u.netloc)
+        if 'Accept-Encoding' not in headers:
+            headers.set('Accept-Encoding', 'identity' if self.download else ACCEPT_ENCODING)
 
         path = u.path
         if u.query:
@@ -89,54 +256,282 @@ class RequestContext(object):
         if query:
             path += ('&' if u.query else '?') + urllib.urlencode(query)
 
-        if u.scheme == 'https':
-            import ssl
-            ctx = ssl._create_unverified_context(certfile=self.certfile,
-                                                 keyfile=self.keyfile)
-            cn = httplib.HTTPSConnection(host, port or 443,
-                                         timeout=self.connect_timeout, context=ctx)
+        full_url = '{}://{}{}'.format(u.scheme, u.netloc, path or '/')
+        if self.session and 'Cookie' not in headers:
+            cookie = self.session.cookie_header(full_url)
+            if cookie:
+                headers = headers.copy()
+                headers.set('Cookie', cookie)
+
+        full_headers = headers
+        if self.download and 'Range' not in headers:
+            brange = self.download.range()
+            if brange:
+                headers = headers.copy()
+                headers.set('Range', brange)
+
+        self.cache_state = entry = None
+        fresh = False
+        if self.use_cache and method == 'GET':
+            entry = response_cache.get(full_url, headers)
+            fresh = entry is not None and entry.fresh
+            if entry is not None and not fresh:
+                headers = entry.add_validators(headers)
+
+        if fresh:
+            self._use_cached(entry, 'cached')
         else:
-            cn = httplib.HTTPConnection(host, port or 80,
-                                        timeout=self.connect_timeout)
+            try:
+                self._fetch(u, host, port, method, path, body, headers)
+            except RestartDownload:
+                self._fetch(u, host, port, method, path, body, full_headers)
+            if self.use_cache and method == 'GET':
+                if entry is not None and self.response.status == 304:
+                    entry.refresh(self.response)
+                    self._use_cached(entry, 'revalidated')
+                else:
+                    response_cache.put(full_url, self.response, self.body, headers)
+
+        self.response.request = ((host, port), full_url)
+        if self.session and self.cache_state != 'cached':
+            self.session.extract(full_url, self.response)
 
+        self.cj = CookieJar()
+        self.cj.load(self.response)
+        return self.response
 
-        cn = send_collector(cn)
+    def _fetch(self, u, host, port, method, path, body, headers):
+        key = (u.scheme, host, port, self.certfile, self.keyfile)
+        cn = connection_pool.get(key)
+        self.reused = cn is not None
+        if self.reused:
+            try:
+                self._send(cn, key, method, path, body, headers)
+            except StaleConnection:
+                if self.cancelled:
+                    raise CancelledError()
+                self.reused = False
+                if self.stream:
+                    self.stream.clear()
+
+        if not self.reused:
+            unix_socket = unix_address(host)
+            if unix_socket:
+                host, port = u.hostname or 'localhost', u.port
+
+            if u.scheme == 'https':
+                ctx = tls_cache.get_context(self.certfile, self.keyfile)
+                cn = TimedHTTPSConnection(host, port or 443, timeout=self.connect_timeout,
+                                          context=ctx, tls_cache=tls_cache,
+                                          unix_socket=unix_socket)
+            else:
+                cn = TimedHTTPConnection(host, port or 80, timeout=self.connect_timeout,
+                                         unix_socket=unix_socket)
+
+            self._send(cn, key, method, path, body, headers)
+
+    def _use_cached(self, entry, state):
+        self.cache_state = state
+        self.response = CachedResponse(entry)
+        self.body = entry.body.copy()
+        self.content = self.body.getvalue()
+        self.size = self.body.size
+        self.encoding = None
+        self.streaming = False
+        if state == 'cached':
+            self.reused = False
+            self.raw_request = self.raw_response = b''
+            self.ctime = self.rtime = self.ftime = 0
+            self.timings = dict.fromkeys(TIMING_PHASES)
+            self.timings['total'] = 0.0
+
+    def _send(self, cn, key, method, path, body, headers):
+        self.cn = cn = capture_connection(cn, self.capture_head, self.capture_tail)
+        self.timings = timings = dict.fromkeys(TIMING_PHASES)
 
         start = time.time()
-        cn.connect()
-        self.ctime = int((time.time() - start) * 1000)
+        if cn.sock is None:
+            cn.connect()
+            timings.update(cn.timings)
+            self.tls_resumed = getattr(cn, 'session_reused', False)
+        connected = time.time()
+        self.ctime = int((connected - start) * 1000)
+
+        if self.cancelled:
+            cn.close()
+            raise CancelledError()
 
         cn.sock.settimeout(self.read_timeout)
 
-        cn.request(method, path, body, headers)
-        self.response = cn.getresponse()
-        self.rtime = int((time.time() - start) * 1000)
+        try:
+            if hasattr(body, 'send_to'):
+                cn.request(method, path, None, headers)
+                body.send_to(cn)
+            else:
+                cn.request(method, path, body, headers)
+            sent = time.time()
+            self.response = cn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            if self.can_retry(cn, method, e):
+                cn.close()
+                raise StaleConnection(e)
+            raise
+        received = time.time()
+        self.rtime = int((received - start) * 1000)
+        timings['write'] = ms(connected, sent)
+        timings['ttfb'] = ms(sent, received)
+
+        if self.download and self.download.accepts(self.response):
+            self.streaming = False
+            try:
+                self.download.save(self.response, BODY_CHUNK_SIZE)
+            except RestartDownload:
+                cn.close()
+                raise
+            self.size = self.wire_size = self.download.size
+            self.downloaded = self.download.path
+            self.body = ResponseBody(self.spill_size)
+            self.body.close()
+        else:
+            self.streaming = self.is_stream(self.response)
+            self.body = self._read_body(self.response)
+        self.content = self.body.getvalue()
+        finished = time.time()
+        self.ftime = int((finished - start) * 1000)
+
+        timings['transfer'] = ms(received, finished)
+        timings['total'] = ms(start, finished)
+
+        if hasattr(cn, 'save_session'):
+            cn.save_session()
 
-        self.content = self.response.read()
-        self.ftime = int((time.time() - start) * 1000)
         self.response.close()
-        cn.close()
+        self.raw_request = cn.request_capture.getvalue()
+        self.raw_response = cn.response_capture.getvalue()
 
-        self.response.request = ((host, port),
-                                 '{}://{}{}'.format(u.scheme, u.netloc, path or '/'))
+        if self.response.will_close:
+            cn.close()
+        else:
+            connection_pool.put(key, cn)
+
+    def can_retry(self, cn, method, error):
+        """Only idempotent requests are resent and only if a reused
+        connection was dropped before any response byte
+        """
+        return (self.reused and method in IDEMPOTENT_METHODS
+                and not cn.response_capture.size and is_stale_error(error))
+
+    def is_stream(self, response):
+        if self.do_redirects and response.status in (301, 302, 303):
+            return False
+
+        return (self.force_stream or response.chunked
+                or get_content_type(response) == 'text/event-stream')
+
+    def _read_body(self, response):
+        """Reads body in chunks
+
+        Compressed bodies are decoded on the fly, :attr:`wire_size` keeps
+        a received size. Streamed chunks are also pushed into :attr:`stream`
+        if a view set it. Bodies larger than :attr:`spill_size` are spilled
+        into a temporary file.
+        """
+        body = ResponseBody(self.spill_size)
+        stream = self.stream if self.streaming else None
+        if self.streaming:
+            read = getattr(response, 'read1', response.read)
+        else:
+            read = response.read
 
-        self.cj = CookieJar()
-        self.cj.load(self.response)
+        self.encoding = response.getheader('Content-Encoding')
+        decoder = make_decoder(self.encoding)
+        if not decoder:
+            self.encoding = None
 
-        self.raw_request = cn._sdata
-        return self.response
+        self.size = self.wire_size = 0
+        try:
+            for data, wire_size in iter_body(read, decoder, BODY_CHUNK_SIZE):
+                self.wire_size += wire_size
+                if not data:
+                    continue
+
+                body.write(data)
+                self.size = body.size
+                if stream is not None:
+                    stream.append(data)
+        finally:
+            body.close()
+
+        return body
+
+    def request_after(self, producers, method, url, query, body, headers):
+        """Executes stale producer requests and applies their captures first"""
+        self.run_producers(producers, headers)
+        return self.request(method, url, query, body, headers)
+
+    def run_producers(self, producers, headers):
+        """Executes producer requests and applies their captures to headers
+
+        `producers` is a list of (name, key, args, templates, tlist).
+        """
+        for name, key, args, templates, tlist in producers:
+            if self.cancelled:
+                raise CancelledError()
+
+            prctx = self.producer = RequestContext()
+            prctx.source = key[0], args[-1]
+            prctx.request(*args[:-1])
+            if prctx.response.status >= 400:
+                raise httplib.HTTPException('producer {} failed: {} {}'.format(
+                    name, prctx.response.status, prctx.response.reason))
+
+            content, _, jdata = format_response(prctx)
+            ctx = make_template_context(prctx, content, jdata)
+            producer_cache.put(key, ctx, templates, tlist, prctx.ttl).apply(headers)
+            self.producers.append((name, 'executed'))
+
+        self.producer = None
 
     def request(self, method, url, query, body, headers):
         self.connect_timeout = float(headers.pop('Vial-Connect-Timeout', CONNECT_TIMEOUT))
         self.read_timeout = float(headers.pop('Vial-Timeout', READ_TIMEOUT))
         self.certfile = headers.pop('Vial-Client-Cert')
         self.keyfile = headers.pop('Vial-Client-Key')
+        self.force_stream = is_true(headers.pop('Vial-Stream', ''))
+        self.spill_size = int(headers.pop('Vial-Spill-Size', SPILL_SIZE))
+        self.capture_head = int(headers.pop('Vial-Capture-Head', CAPTURE_HEAD))
+        self.capture_tail = int(headers.pop('Vial-Capture-Tail', CAPTURE_TAIL))
+        self.fast_json = is_true(headers.pop('Vial-Fast-Json', ''))
+        self.use_cache = is_true(headers.pop('Vial-Cache', ''))
+        headers.pop('Vial-Profile')
+        if 'Vial-Depends' in headers:
+            raise PrepareException('Vial-Depends should be resolved before a request')
+        self.name = headers.pop('Vial-Name', None)
+        self.ttl = float(headers.pop('Vial-Ttl', PRODUCER_TTL))
+        download = headers.pop('Vial-Download', None)
+        if download:
+            self.download = Download(os.path.expanduser(download))
+            self.use_cache = False
+        record = headers.pop('Vial-History', None)
+        record = self.record if record is None else is_true(record)
+        session = headers.pop('Vial-Session', '')
+        name = session_name(session, self.source)
+        if name:
+            self.session = get_session(name)
+        elif is_true(session):
+            raise PrepareException('Vial-Session: {} needs a saved request file, '
+                                   'use a session name instead'.format(session))
+        self.method = method
         self.history = []
 
-        do_redirects = headers.pop('Vial-Redirect', '').lower() in ('1', 't', 'true', 'yes')
+        self.do_redirects = do_redirects = is_true(headers.pop('Vial-Redirect', ''))
+        pop_control_headers(headers, ('vial-connect',))
         original_headers = headers
 
         for _ in range(5):
+            if self.cancelled:
+                raise CancelledError()
+
             resp = self._request(method, url, query, body, headers)
             self.history.append(resp)
 
@@ -147,12 +542,26 @@ class RequestContext(object):
             if not url:
                 break
 
+            url = urlparse.urljoin(resp.request[1], url)
+
             u = urlparse.urlsplit(url)
             if u.netloc == headers.get('Host'):
                 headers = original_headers
             else:
                 headers = original_headers.copy('User-Agent')
 
+        if self.session:
+            try:
+                self.session.save()
+            except EnvironmentError:
+                pass
+
+        if record and self.source and not self.downloaded:
+            try:
+                self.history_id = request_history.add(self, *self.source)
+            except (sqlite3.Error, EnvironmentError):
+                pass
+
     @property
     def rcookies(self):
         return {k: v.value for k, v in iteritems(self.cj.cookies)}
@@ -162,91 +571,1046 @@ class RequestContext(object):
         return {k: v.coded_value for k, v in iteritems(self.cj.cookies)}
 
 
-def parse_request_at_cursor():
-    lines = vim.current.buffer[:]
+def input_func(param):
+    return vfunc.input('{}: '.format(param))
+
+
+def pwd_func(param):
+    return vfunc.inputsecret('{}: '.format(param))
+
+
+def watch_changes(buf):
+    """Tracks a first changed line of a buffer in b:vial_http_changed
+
+    Uses listener_add if vim has it, returns False otherwise.
+    """
+    if not int(vfunc.exists('*listener_add')):
+        return False
+
+    vim.eval("listener_add({{b, s, e, a, c -> setbufvar(b, 'vial_http_changed', "
+             "min([getbufvar(b, 'vial_http_changed', s), s]))}}, {})".format(buf.number))
+    return True
+
+
+def pop_changed_line(buf):
+    """Returns 0-based first changed line since a last call or None"""
+    vfunc.listener_flush(buf.number)
+    changed = buf.vars.get('vial_http_changed')
+    if changed is None:
+        return None
+    del buf.vars['vial_http_changed']
+    return int(changed) - 1
+
+
+def get_document(buf):
+    """Returns parsed buffer content cached by b:changedtick
+
+    If vim reports changed lines only lines after a first changed one
+    are read from a buffer, otherwise all lines are compared.
+    """
+    tick = int(vim.eval('getbufvar({}, "changedtick")'.format(buf.number)))
+    try:
+        doc_tick, doc, watched = documents[buf.number]
+    except KeyError:
+        doc = Document(buf[:])
+        watched = watch_changes(buf)
+    else:
+        if doc_tick != tick:
+            changed = pop_changed_line(buf) if watched else None
+            if changed is None:
+                doc.update(buf[:])
+            else:
+                doc.update(doc.lines[:changed] + buf[changed:], changed)
+
+    documents[buf.number] = tick, doc, watched
+    return doc
+
+
+def parse_request(doc, line, profiler=None):
+    profiler = profiler or Profiler()
+    with profiler.stage('headers and templates'):
+        headers, templates = doc.get_headers_and_templates(line)
+    with profiler.stage('prepare request'):
+        return (headers, templates) + prepare_request(doc.lines, line, headers, input_func,
+                                                      pwd_func, doc.find_request(line))
+
+
+def request_source(buf, line):
+    """Returns (file, first line of a request block) to key history records"""
+    spans = get_document(buf).find_requests(line, line)
+    return buf.name, spans[0][0] if spans else line
+
+
+def request_anchor(doc, first, rend):
+    """Returns (first line, lines) of a request block to find it after edits"""
+    return first, doc.lines[first:rend + 1]
+
+
+def parse_request_at_cursor(profiler=None):
+    profiler = profiler or Profiler()
     line, _ = vim.current.window.cursor
-    line -= 1
+    with profiler.stage('read buffer'):
+        doc = get_document(vim.current.buffer)
+    return parse_request(doc, line - 1, profiler)
+
+
+def global_option(name, default=''):
+    value = vim.vars.get(name, default)
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
 
-    headers, templates = get_headers_and_templates(lines, line)
-    pwd_func = lambda p: vfunc.inputsecret('{}: '.format(p))
-    input_func = lambda p: vfunc.input('{}: '.format(p))
-    return (headers, templates) + prepare_request(lines, line, headers, input_func, pwd_func)
+def history_enabled():
+    return is_true(global_option('vial_http_history'))
 
 
 def http():
+    profiler = Profiler()
+    profiler.enable(profile_mode(global_option('vial_http_profile')))
     try:
-        headers, templates, method, url, query, body, tlist, rend = parse_request_at_cursor()
+        headers, templates, method, url, query, body, tlist, rend = parse_request_at_cursor(profiler)
     except PrepareException as e:
+        profiler.pause()
         echoerr(str(e))
         return
 
+    states = []
+    with profiler.stage('producers'):
+        try:
+            producers = prepare_producers(vim.current.buffer, headers, states)
+        except PrepareException as e:
+            profiler.pause()
+            echoerr(str(e))
+            return
+
+    source = request_source(vim.current.buffer, vim.current.window.cursor[0] - 1)
+    if 'Vial-Bench-Requests' in headers or 'Vial-Bench-Concurrency' in headers:
+        profiler.pause()
+        return run_bench(method, url, query, body, headers, producers=producers,
+                         source=source)
+
+    if 'Vial-Hosts' in headers:
+        profiler.pause()
+        try:
+            hosts = parse_hosts(headers.pop('Vial-Hosts'), templates)
+        except PrepareException as e:
+            echoerr(str(e))
+            return
+        return FanOut(method, url, query, body, headers, hosts, producers, source).start()
+
+    profiler.enable(profile_mode(headers.pop('Vial-Profile', None)) or profiler.mode)
     rctx = RequestContext()
-    rctx.request(method, url, query, body, headers)
+    rctx.source = source
+    rctx.record = history_enabled()
+    rctx.profiler = profiler
+    rctx.producers = states
+    bufnr = vim.current.buffer.number
+    anchor = request_anchor(get_document(vim.current.buffer), rctx.source[1], rend)
+
+    def done(job):
+        profiler.resume()
+        for phase in TIMING_PHASES + ('total',):
+            profiler.add('network ' + phase, (getattr(rctx, 'timings', None) or {}).get(phase))
+
+        if job.cancelled or isinstance(job.error, CancelledError):
+            vim.command('echo "VialHttp: request cancelled"')
+        elif job.error:
+            echoerr('VialHttp: {} {}: {}'.format(method, url, job.error))
+        else:
+            show_response(rctx, templates, tlist, bufnr, anchor)
+        profiler.pause()
+
+    view = DownloadView if 'Vial-Download' in headers else StreamView
+    profiler.pause()
+    func = partial(rctx.request_after, producers) if producers else rctx.request
+    job = Job(profiler.wrap(func), method, url, query, body, headers)
+    job.on_cancel(rctx.cancel).on_progress(view(rctx)).on_done(done)
+    run_job(job)
+
+
+def prepare_producers(buf, headers, states, doc=None):
+    """Resolves Vial-Depends header of a request in a buffer
+
+    Every runner should call it, see :func:`resolve_producers`.
+    """
+    depends = headers.pop('Vial-Depends', None)
+    if not depends:
+        return []
+    return resolve_producers(producer_cache, doc or get_document(buf), buf.name,
+                             depends, headers, states, parse_request)
+
+
+def execute_producers(producers, headers, active):
+    """Executes producers once before parallel runs of a request"""
+    if not producers:
+        return
+    rctx = RequestContext()
+    active.add(rctx)
+    try:
+        rctx.run_producers(producers, headers)
+    finally:
+        active.discard(rctx)
+
+
+def has_timers():
+    return bool(int(vfunc.exists('*timer_start')))
+
+
+def run_job(job):
+    """Executes job in background if vim supports timers
+
+    Otherwise job is executed synchronously.
+    """
+    if not has_timers():
+        job.run()
+        report_errors(job.progress())
+        job.finish()
+        return
+
+    jobs.add(job.start())
+    if poll_timer[0] is None:
+        poll_timer[0] = int(vim.eval("timer_start({}, {{t -> VialHttpPoll()}}, "
+                                     "{{'repeat': -1}})".format(POLL_INTERVAL)))
+
+
+def report_errors(errors):
+    for e in errors:
+        echoerr('VialHttp: {}'.format(e))
 
+
+def poll():
+    connection_pool.expire()
+    for job in jobs.running():
+        report_errors(job.progress())
+
+    for job in jobs.pop_finished():
+        report_errors(job.progress())
+        try:
+            job.finish()
+        except Exception as e:
+            echoerr('VialHttp: {}'.format(e))
+
+    if not len(jobs) and poll_timer[0] is not None:
+        vfunc.timer_stop(poll_timer[0])
+        poll_timer[0] = None
+
+
+def cancel():
+    cnt = jobs.cancel()
+    vim.command('echo "VialHttp: {} request(s) cancelled"'.format(cnt))
+
+
+class DownloadView(object):
+    """Shows download progress in __vial_http__ status line"""
+    def __init__(self, rctx):
+        self.rctx = rctx
+        self.win = None
+
+    def __call__(self, job):
+        rctx = self.rctx
+        if not rctx.download or rctx.download.start is None or job.done:
+            return
+
+        if self.win is None:
+            cwin = vim.current.window
+            self.win, buf = make_scratch('__vial_http__')
+            vim.command('set filetype=text')
+            buf[:] = [bstr('Downloading into {}'.format(rctx.download.path), 'utf-8')]
+            focus_window(cwin)
+
+        if self.win.valid:
+            self.win.options['statusline'] = 'Downloading: {} {} {}'.format(
+                rctx.response.status, rctx.response.reason, format_download(rctx.download))
+
+
+class StreamView(object):
+    """Appends streamed response body into __vial_http__ buffer
+
+    Only complete lines are appended, incomplete tail waits for
+    a next chunk. Chunks are collected only for background jobs,
+    nothing drains them during a synchronous execution.
+    """
+    def __init__(self, rctx):
+        self.rctx = rctx
+        self.win = self.buf = None
+        self.empty = True
+        if has_timers():
+            rctx.stream = LineStream()
+
+    def __call__(self, job):
+        rctx = self.rctx
+        if not rctx.streaming or rctx.stream is None:
+            return
+
+        if self.buf is None:
+            cwin = vim.current.window
+            self.win, self.buf = make_scratch('__vial_http__')
+            vim.command('set filetype=text')
+            self.buf[:] = []
+            focus_window(cwin)
+
+        lines = rctx.stream.lines(job.done)
+        if lines:
+            if self.empty:
+                self.buf[:] = lines
+                self.empty = False
+            else:
+                self.buf.append(lines)
+
+        if self.win.valid:
+            self.win.options['statusline'] = 'Streaming: {} {} ttfb {}ms {}'.format(
+                rctx.response.status, rctx.response.reason,
+                format_ms(rctx.timings['ttfb']), format_size(rctx))
+            if lines and vim.current.window != self.win:
+                self.win.cursor = len(self.buf), 0
+
+
+def show_response(rctx, templates, tlist, bufnr, anchor):
     cwin = vim.current.window
+    last_response[0] = rctx
+    profiler = rctx.profiler or Profiler()
+
+    with profiler.stage('fill __vial_http_req__'):
+        win, buf = make_scratch('__vial_http_req__', title='Request')
+        rlines = rctx.raw_request.splitlines()
+
+        hlines = []
+        for r in rctx.history[:-1]:
+            hlines.append(bstr('Redirect {} from {}'.format(
+                r.status, r.request[1]), 'utf-8'))
+        for name, state in rctx.producers:
+            hlines.append(bstr('Producer {}: {}'.format(name, state), 'utf-8'))
+        if rctx.cache_state == 'cached':
+            hlines.append(b'Served from cache')
+        if rctx.encoding:
+            hlines.append(bstr('Encoding {}: {} on wire, {} decoded'.format(
+                rctx.encoding, sizeof_fmt(rctx.wire_size), sizeof_fmt(rctx.size)), 'utf-8'))
+        if hlines:
+            hlines.append(b'----------------')
+
+        if rctx.raw_response:
+            rlines.append(b'----------------')
+            rlines.extend(r.replace(b'\0', b'^@')
+                          for r in rctx.raw_response.splitlines())
+
+        buf[:] = hlines + rlines
+        win.cursor = 1, 0
+
+    with profiler.stage('fill __vial_http_hdr__'):
+        win, buf = make_scratch('__vial_http_hdr__', title='Response headers')
+        if PY2:
+            buf[:] = [r.rstrip('\r\n') for r in rctx.response.msg.headers]
+        else:
+            buf[:] = ['{}: {}'.format(*r).encode('utf-8') for r in rctx.response.msg._headers]
 
-    win, buf = make_scratch('__vial_http_req__', title='Request')
-    rlines = rctx.raw_request.splitlines()
+        win.cursor = 1, 0
+
+    spilled = rctx.body.spilled
+    if spilled:
+        keep_spilled(rctx.body)
+
+    with profiler.stage('fill __vial_http_raw__'):
+        win, buf = make_scratch('__vial_http_raw__', title='Raw Response')
+        if spilled:
+            Pager(rctx.body.path).attach(buf)
+        else:
+            buf[:] = rctx.content.splitlines()
+        win.cursor = 1, 0
+
+    with profiler.stage('format'):
+        content, ctype, jdata = format_response(rctx)
+
+    with profiler.stage('fill __vial_http__'):
+        win, buf = make_scratch('__vial_http__')
+        win.options['statusline'] = 'Response: {} {} {}ms {}ms {}{}{}{}{}'.format(
+            rctx.response.status, rctx.response.reason,
+            rctx.ctime, rctx.rtime, format_size(rctx),
+            ' (reused)' if rctx.reused else '',
+            ' ({})'.format(rctx.cache_state) if rctx.cache_state else '',
+            ' (resumed)' if rctx.tls_resumed else '',
+            ' (spilled)' if spilled else '') + ' [{}]'.format(format_timings(rctx.timings))
+        streamed = rctx.streaming and rctx.stream is not None
+        if rctx.downloaded:
+            vim.command('set filetype=text')
+            buf[:] = [bstr('Saved {} into {}{}'.format(
+                sizeof_fmt(rctx.size), rctx.downloaded,
+                ', resumed from {}'.format(sizeof_fmt(rctx.download.offset))
+                if rctx.download.offset else ''), 'utf-8')]
+            win.cursor = 1, 0
+        elif ctype in ('json', 'xml') and isinstance(content, lazy):
+            vim.command('set filetype={}'.format(ctype))
+            source = map_file(rctx.body.path) if spilled else rctx.content
+            if ctype == 'json':
+                chunks = iter_pretty_json(source)
+            else:
+                chunks = iter_pretty_xml(source if spilled else StringIO(source))
+            StreamPager(chunks).attach(buf)
+            win.cursor = 1, 0
+        elif spilled and not streamed:
+            vim.command('set filetype=text')
+            Pager(rctx.body.path).attach(buf)
+            win.cursor = 1, 0
+        elif not spilled:
+            vim.command('set filetype={}'.format(ctype))
+            buf[:] = content.splitlines(False)
+            win.cursor = 1, 0
+
+    focus_window(cwin)
+
+    ctx = make_template_context(rctx, content, jdata)
+    remember_producer(rctx, ctx, templates, tlist)
+    render_templates(ctx, templates, tlist, bufnr, anchor, profiler)
+
+    if profiler.mode:
+        show_profile(profiler)
+
+
+def remember_producer(rctx, ctx, templates, tlist):
+    if rctx.name and rctx.source and rctx.response.status < 400:
+        producer_cache.put((rctx.source[0], rctx.name), ctx, templates, tlist, rctx.ttl)
+
+
+def show_profile(profiler):
+    cwin = vim.current.window
+    win, buf = make_scratch('__vial_http_profile__', title='Profile')
+    vim.command('set filetype=text')
+    buf[:] = profiler.report()
+    win.cursor = 1, 0
+    focus_window(cwin)
+
+
+def format_response(rctx):
+    """Returns (content, filetype, jdata) for response body
+
+    Spilled bodies are not formatted in place, content and jdata are
+    lazily loaded from a spill file on a first access from templates.
+    Json and xml are formatted by pages with :class:`StreamPager`.
+    """
+    if rctx.downloaded:
+        return rctx.content, 'text', {}
+
+    ctype = get_content_type(rctx.response)
+    if rctx.body.spilled:
+        body = rctx.body
+        jdata = lazy(lambda: load_json(body.read()))
+        if not rctx.streaming and ctype == 'application/json':
+            return lazy(lambda: b''.join(iter_pretty_json(body.read()))), 'json', jdata
+        if not rctx.streaming and is_xml(ctype):
+            return lazy(lambda: try_pretty_xml(body.read())), 'xml', jdata
+        return lazy(body.read), None, jdata
 
-    hlines = []
-    for r in rctx.history[:-1]:
-        hlines.append(bstr('Redirect {} from {}'.format(
-            r.status, r.request[1]), 'utf-8'))
-    if hlines:
-        hlines.append(b'----------------')
+    return format_content(ctype, rctx.content, rctx.fast_json)
+
+
+def keep_spilled(body):
+    """Keeps only a few last spilled bodies on disk
+
+    Pagers still can read discarded files via their memory maps.
+    """
+    spilled_bodies.append(body)
+    while len(spilled_bodies) > SPILL_KEEP:
+        spilled_bodies.pop(0).discard()
+
+
+def more():
+    buf = vim.current.buffer
+    pager = pagers.get(buf.number)
+    if not pager:
+        return
 
-    buf[:] = hlines + rlines
+    buf.append(pager.next_lines())
+    if pager.done:
+        del pagers[buf.number]
+        buf.vars['vial_http_paged'] = 0
+
+
+def timings():
+    rctx = last_response[0]
+    if not rctx:
+        echoerr('There is no response yet')
+        return
+
+    cwin = vim.current.window
+    win, buf = make_scratch('__vial_http_timings__', title='Timings')
+    buf[:] = format_waterfall(rctx)
     win.cursor = 1, 0
+    focus_window(cwin)
 
-    win, buf = make_scratch('__vial_http_hdr__', title='Response headers')
-    if PY2:
-        buf[:] = [r.rstrip('\r\n') for r in rctx.response.msg.headers]
+
+def format_waterfall(rctx, width=40):
+    """Returns lines with a phase table and bars placed on a time scale"""
+    t = rctx.timings
+    total = t['total'] or 1
+    lines = ['{} {} {}{}'.format(rctx.response.request[1], rctx.response.status,
+                                 rctx.response.reason, ' (reused)' if rctx.reused else ''),
+             '',
+             '{:<10}{:>10}{:>10}'.format('PHASE', 'MS', 'START')]
+
+    offset = 0
+    for p in TIMING_PHASES:
+        value = t[p]
+        if value is None:
+            lines.append('{:<10}{:>10}{:>10}'.format(p, '-', '-'))
+            continue
+
+        pos = int(offset / total * width)
+        bar = max(1, int(round(value / total * width)))
+        lines.append('{:<10}{:>10.1f}{:>10.1f}  {}{}'.format(
+            p, value, offset, ' ' * pos, '#' * min(bar, width - pos or 1)))
+        offset += value
+
+    lines.append('{:<10}{:>10.1f}'.format('total', t['total']))
+    return lines
+
+
+def history(query=None):
+    """Shows recorded requests
+
+    Without args shows latest requests, ``.`` shows requests of
+    a request block under cursor and other value is an url prefix.
+    """
+    if query == '.':
+        file, line = request_source(vim.current.buffer, vim.current.window.cursor[0] - 1)
+        records = request_history.for_source(file, line)
+    elif query:
+        records = request_history.for_url(query)
     else:
-        buf[:] = ['{}: {}'.format(*r).encode('utf-8') for r in rctx.response.msg._headers]
+        records = request_history.latest()
 
+    win, buf = make_scratch('__vial_http_history__', title='History')
+    buf[:] = format_history(records)
+    vim.command('nnoremap <buffer> <silent> <cr> :VialHttpHistoryShow<cr>')
     win.cursor = 1, 0
 
-    size = len(rctx.content)
 
-    win, buf = make_scratch('__vial_http_raw__', title='Raw Response')
-    buf[:] = rctx.content.splitlines()
+def format_history(records):
+    totals = sorted(r['timings'].get('total') or 0 for r in records)
+    lines = ['{} requests, total p50 {} p95 {} max {}'.format(
+        len(records), *[format_ms(percentile(totals, p)) for p in (50, 95, 100)]), '',
+        '{:<8}{:<21}{:<8}{:>10}{:>10}{:>10}  {}'.format(
+            'ID', 'TIME', 'STATUS', 'TOTAL', 'TTFB', 'SIZE', 'REQUEST')]
+
+    for r in records:
+        t = r['timings']
+        lines.append('{:<8}{:<21}{:<8}{:>10}{:>10}{:>10}  {} {}'.format(
+            r['id'], datetime.datetime.fromtimestamp(r['time']).strftime('%Y-%m-%d %H:%M:%S'),
+            r['status'], format_ms(t.get('total')), format_ms(t.get('ttfb')),
+            sizeof_fmt(r['size']), r['method'], r['url']))
+
+    return lines
+
+
+def format_ms(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def history_show():
+    try:
+        rid = int(vim.current.line.split()[0])
+    except (IndexError, ValueError):
+        return
+
+    record = request_history.get(rid)
+    if not record:
+        echoerr('VialHttp: history record {} not found'.format(rid))
+        return
+
+    cwin = vim.current.window
+    win, buf = make_scratch('__vial_http_req__', title='Request')
+    buf[:] = record['request'].splitlines()
     win.cursor = 1, 0
 
-    if PY2:
-        rcontent_type = rctx.response.msg.gettype()
-    else:
-        rcontent_type = rctx.response.msg.get_content_type()
+    win, buf = make_scratch('__vial_http_hdr__', title='Response headers')
+    buf[:] = ['{}: {}'.format(*r).encode('utf-8') for r in record['headers']]
+    win.cursor = 1, 0
 
-    content, ctype, jdata = format_content(rcontent_type, rctx.content)
+    ctype = 'text/plain'
+    for k, v in record['headers']:
+        if k.lower() == 'content-type':
+            ctype = v.split(';')[0].strip().lower()
 
     win, buf = make_scratch('__vial_http__')
-    win.options['statusline'] = 'Response: {} {} {}ms {}ms {}'.format(
-        rctx.response.status, rctx.response.reason,
-        rctx.ctime, rctx.rtime, sizeof_fmt(size))
-    vim.command('set filetype={}'.format(ctype))
-    buf[:] = content.splitlines(False)
+    win.options['statusline'] = 'History #{}: {} {} {} {}ms {}'.format(
+        rid, record['status'], record['reason'],
+        datetime.datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S'),
+        format_ms(record['timings'].get('total')), sizeof_fmt(record['size']))
+    if record['body_path']:
+        vim.command('set filetype=text')
+        try:
+            Pager(record['body_path']).attach(buf)
+        except EnvironmentError as e:
+            buf[:] = ['ERROR: {}'.format(e)]
+    else:
+        content, filetype, _ = format_content(ctype, record['body'])
+        vim.command('set filetype={}'.format(filetype))
+        buf[:] = content.splitlines(False)
     win.cursor = 1, 0
 
     focus_window(cwin)
 
+
+def make_template_context(rctx, content, jdata):
     def set_cookies(*args):
         cookies = rctx.cookies
         args = args or sorted(cookies.keys())
         return 'Cookie: ' + ';'.join('{}={}'.format(k, cookies[k]) for k in args)
 
-    ctx = {'body': content, 'json': jdata,
-           'headers': Headers(rctx.response.getheaders()),
-           'cookies': rctx.cookies,
-           'rcookies': rctx.rcookies,
-           'set_cookies': set_cookies}
+    return {'body': content, 'json': jdata,
+            'headers': Headers(rctx.response.getheaders()),
+            'cookies': rctx.cookies,
+            'rcookies': rctx.rcookies,
+            'timings': rctx.timings,
+            'profile': dict(rctx.profiler.stages) if rctx.profiler else {},
+            'set_cookies': set_cookies}
+
 
+def render_templates(ctx, templates, tlist, bufnr, anchor, profiler=None):
+    """Appends rendered templates after a request block of a buffer
+
+    A block is found again by `anchor` from :func:`request_anchor`, lines
+    could be changed while a request was executed. Returns number of
+    inserted lines.
+    """
+    try:
+        tbuf = vim.buffers[bufnr]
+    except KeyError:
+        return 0
+
+    if not tlist:
+        return 0
+
+    first, block = anchor
+    first = get_document(tbuf).locate_request(first, block)
+    if first is None:
+        echoerr('VialHttp: request was changed, templates are not rendered')
+        return 0
+    rend = first + len(block) - 1
+
+    inserted = 0
+    profiler = profiler or Profiler()
     for t in tlist:
-        if t in templates:
-            lines = render_template(templates[t], **ctx).splitlines()
-        else:
-            lines = ['ERROR: template {} not found'.format(t)]
-        vfunc.append(rend + 1, [''] + lines)
+        with profiler.stage('template ' + t):
+            if t in templates:
+                lines = render_template(templates[t], **ctx).splitlines()
+            else:
+                lines = ['ERROR: template {} not found'.format(t)]
+        tbuf.append([''] + lines, rend + 1)
         rend += 1 + len(lines)
+        inserted += 1 + len(lines)
+
+    return inserted
+
+
+class BatchItem(object):
+    def __init__(self, line, method=None, url=None, error=None):
+        self.line = line
+        self.method = method
+        self.url = url
+        self.error = error
+        self.done = False
+        self.rctx = self.request = None
+        self.templates, self.tlist, self.anchor = {}, [], (line, [])
+
+
+class BatchRun(object):
+    """Executes requests in a line range stage by stage
+
+    Requests of a stage are executed in parallel. A request with templates
+    ends a stage because its captures can change following requests.
+    """
+    def __init__(self, bufnr, start, end):
+        self.bufnr = bufnr
+        self.source = vim.buffers[bufnr].name
+        self.start = start
+        self.end = end
+        self.processed = 0
+        self.items = []
+        self.started = time.time()
+        self.finished = False
+        self.cancelled = False
+        self.record = history_enabled()
+
+    def next_stage(self):
+        try:
+            doc = get_document(vim.buffers[self.bufnr])
+        except KeyError:
+            doc = Document([])
+
+        requests = doc.find_requests(self.start, self.end)[self.processed:]
+        if not requests:
+            self.finished = True
+            self.show()
+            return
+
+        stage = []
+        for line, _ in requests:
+            self.processed += 1
+            states = []
+            try:
+                (headers, templates, method, url, query, body,
+                 tlist, rend) = parse_request(doc, line)
+                producers = prepare_producers(vim.buffers[self.bufnr], headers, states, doc)
+            except PrepareException as e:
+                self.items.append(BatchItem(line, error=str(e)))
+                continue
+
+            item = BatchItem(line, method, url)
+            item.rctx = RequestContext()
+            item.rctx.source = self.source, line
+            item.rctx.record = self.record
+            item.rctx.producers = states
+            item.request = partial(item.rctx.request_after, producers,
+                                   method, url, query, body, headers)
+            item.templates, item.tlist = templates, tlist
+            item.anchor = request_anchor(doc, line, rend)
+            self.items.append(item)
+            stage.append(item)
+            if tlist:
+                break
+
+        if not stage:
+            return self.next_stage()
+
+        def cancel():
+            self.cancelled = True
+            for it in stage:
+                it.rctx.cancel()
+
+        job = Job(run_parallel, [r.request for r in stage], BATCH_CONCURRENCY,
+                  lambda: self.cancelled)
+        job.on_cancel(cancel).on_done(partial(self.stage_done, stage))
+        self.show()
+        run_job(job)
+
+    def stage_done(self, stage, job):
+        for item, (_, error) in zip(stage, job.result or []):
+            if error:
+                item.error = str(error) or error.__class__.__name__
+            item.done = True
+
+        if self.cancelled or job.error:
+            self.finished = True
+            self.show()
+            return
+
+        item = stage[-1]
+        if item.tlist and not item.error:
+            rctx = item.rctx
+            content, _, jdata = format_response(rctx)
+            ctx = make_template_context(rctx, content, jdata)
+            remember_producer(rctx, ctx, item.templates, item.tlist)
+            self.end += render_templates(ctx, item.templates, item.tlist,
+                                         self.bufnr, item.anchor)
+
+        for item in stage:
+            if item.rctx.body:
+                item.rctx.body.discard()
+
+        self.next_stage()
+
+    def show(self):
+        cwin = vim.current.window
+        win, buf = make_scratch('__vial_http_batch__', title='Batch')
+
+        lines = ['{:<6} {:<6} {:>7} {:>7} {:>7} {:>8}  {}'.format(
+            'LINE', 'STATUS', 'CTIME', 'RTIME', 'FTIME', 'SIZE', 'REQUEST')]
+        failed = 0
+        for item in self.items:
+            request = '{} {}'.format(item.method, item.url) if item.method else ''
+            if item.error:
+                failed += 1
+                lines.append('{:<6} ERROR  {}  {}'.format(item.line + 1, request, item.error))
+            elif item.done:
+                rctx = item.rctx
+                lines.append('{:<6} {:<6} {:>5}ms {:>5}ms {:>5}ms {:>8}  {}'.format(
+                    item.line + 1, rctx.response.status, rctx.ctime, rctx.rtime,
+                    rctx.ftime, sizeof_fmt(rctx.size), request))
+            else:
+                lines.append('{:<6} ...     {}'.format(item.line + 1, request))
+
+        buf[:] = lines
+
+        if self.cancelled:
+            state = 'cancelled'
+        elif self.finished:
+            state = 'done in {:.1f}s'.format(time.time() - self.started)
+        else:
+            state = 'running'
+        win.options['statusline'] = 'Batch: {} requests, {} failed, {}'.format(
+            len(self.items), failed, state)
+        focus_window(cwin)
+
+
+def run_lines(line1, line2):
+    batch = BatchRun(vim.current.buffer.number, int(line1) - 1, int(line2) - 1)
+    batch.next_stage()
+
+
+def run_all():
+    batch = BatchRun(vim.current.buffer.number, 0, len(vim.current.buffer) - 1)
+    batch.next_stage()
+
+
+class BenchResult(object):
+    """Numbers of a finished bench request, its context isn't kept"""
+    __slots__ = ('status', 'ctime', 'rtime', 'ftime', 'size')
+
+    def __init__(self, rctx):
+        self.status = rctx.response.status
+        self.ctime = rctx.ctime
+        self.rtime = rctx.rtime
+        self.ftime = rctx.ftime
+        self.size = rctx.size
+
+
+class Bench(object):
+    """Repeats a request `total` times using `concurrency` threads
+
+    Stale producers are executed once before the first request. Only
+    :class:`BenchResult` of each request is kept, bodies are discarded
+    and raw bytes are not captured.
+    """
+    def __init__(self, method, url, query, body, headers, total, concurrency,
+                 producers=(), source=None):
+        self.method = method
+        self.source = source
+        self.url = url
+        self.args = method, url, query, body
+        self.headers = headers
+        headers.set('Vial-Capture-Head', '0')
+        headers.set('Vial-Capture-Tail', '0')
+        self.producers = producers
+        self.total = total
+        self.concurrency = concurrency
+        self.active = set()
+        self.completed = 0
+        self.cancelled = False
+
+    def one(self):
+        rctx = RequestContext()
+        rctx.source = self.source
+        self.active.add(rctx)
+        try:
+            rctx.request(*self.args, headers=Headers(list(self.headers.items())))
+        finally:
+            self.active.discard(rctx)
+            self.completed += 1
+            if rctx.body:
+                rctx.body.discard()
+        return BenchResult(rctx)
+
+    def cancel(self):
+        self.cancelled = True
+        for rctx in list(self.active):
+            rctx.cancel()
+
+    def run(self):
+        execute_producers(self.producers, self.headers, self.active)
+        self.started = time.time()
+        return run_parallel([self.one] * self.total, self.concurrency,
+                            lambda: self.cancelled)
+
+    def start(self):
+        self.started = time.time()
+        job = Job(self.run)
+        job.on_cancel(self.cancel).on_progress(self.progress).on_done(self.done)
+        run_job(job)
+
+    def progress(self, job):
+        if not job.done:
+            self.show(['Running: {}/{}'.format(self.completed, self.total)])
+
+    def done(self, job):
+        if job.error:
+            echoerr('VialHttp: {}'.format(job.error))
+            return
+        self.show(self.report(job.result, time.time() - self.started))
+
+    def report(self, results, elapsed):
+        elapsed = max(elapsed, 0.001)
+        ok = [r for r, e in results if not e]
+        errors = Counter('{}: {}'.format(e.__class__.__name__, e)
+                         for _, e in results if e)
+        statuses = Counter(r.status for r in ok)
+        size = sum(r.size for r in ok)
+
+        lines = ['{} {}'.format(self.method, self.url), '',
+                 'Requests: {}  Concurrency: {}  Time: {:.2f}s'.format(
+                     len(results), self.concurrency, elapsed),
+                 'Throughput: {:.1f} req/s  {}/s'.format(
+                     len(results) / elapsed, sizeof_fmt(size / elapsed)),
+                 'Errors: {}'.format(sum(errors.values())),
+                 '',
+                 '{:<12}{:>8}{:>8}{:>8}{:>8}'.format('', 'p50', 'p90', 'p99', 'max')]
+
+        phases = (('connect', 'ctime'), ('first byte', 'rtime'), ('full', 'ftime'))
+        for name, attr in phases:
+            values = sorted(getattr(r, attr) for r in ok)
+            pvalues = [percentile(values, p) for p in (50, 90, 99, 100)]
+            lines.append('{:<12}'.format(name) + ''.join(
+                '{:>8}'.format('-' if v is None else '{}ms'.format(v)) for v in pvalues))
+
+        lines.extend(['', 'Status:'])
+        lines.extend('  {}  {}'.format(k, v) for k, v in sorted(statuses.items()))
+
+        if errors:
+            lines.extend(['', 'Errors:'])
+            lines.extend('  {}  {}'.format(v, k) for k, v in errors.most_common())
+
+        lines.extend(['', 'Full time histogram:'])
+        lines.extend(histogram([r.ftime for r in ok]))
+        return lines
+
+    def show(self, lines):
+        cwin = vim.current.window
+        win, buf = make_scratch('__vial_http_bench__', title='Bench')
+        win.options['statusline'] = 'Bench: {}/{} requests'.format(
+            self.completed, self.total)
+        buf[:] = lines
+        focus_window(cwin)
+
+
+def body_digest(body):
+    """Short sha1 of response body content"""
+    digest = hashlib.sha1()
+    if body.spilled:
+        with open(body.path, 'rb') as f:
+            for chunk in iter(partial(f.read, BODY_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        digest.update(body.getvalue())
+    return digest.hexdigest()[:12]
+
+
+class FanOut(object):
+    """Executes a request against each of target hosts in parallel
+
+    Targets are passed as ``Vial-Connect``, so a request keeps its ``Host``
+    header. Responses with status or body hash different from the most
+    common one are marked as divergent. Stale producers are executed once
+    before fan-out.
+    """
+    def __init__(self, method, url, query, body, headers, hosts, producers=(), source=None):
+        self.method = method
+        self.source = source
+        self.url = url
+        self.args = method, url, query, body
+        self.headers = headers
+        self.hosts = hosts
+        self.producers = producers
+        self.active = set()
+        self.completed = 0
+        self.cancelled = False
+
+        _, u = get_connection_settings(url, headers.copy())
+        self.targets = [h if '://' in h or h.startswith('unix:')
+                        else '{}://{}'.format(u.scheme, h) for h in hosts]
+
+    def one(self, target, headers):
+        rctx = RequestContext()
+        rctx.source = self.source
+        headers.set('Vial-Connect', target)
+        self.active.add(rctx)
+        try:
+            rctx.request(*self.args, headers=headers)
+            rctx.digest = body_digest(rctx.body)
+        finally:
+            self.active.discard(rctx)
+            self.completed += 1
+            if rctx.body:
+                rctx.body.discard()
+        return rctx
+
+    def cancel(self):
+        self.cancelled = True
+        for rctx in list(self.active):
+            rctx.cancel()
+
+    def run(self):
+        execute_producers(self.producers, self.headers, self.active)
+        funcs = [partial(self.one, t, self.headers.copy()) for t in self.targets]
+        return run_parallel(funcs, FANOUT_CONCURRENCY, lambda: self.cancelled)
+
+    def start(self):
+        job = Job(self.run)
+        job.on_cancel(self.cancel).on_progress(self.progress).on_done(self.done)
+        run_job(job)
+
+    def progress(self, job):
+        if not job.done:
+            self.show(['Running: {}/{}'.format(self.completed, len(self.hosts))])
+
+    def done(self, job):
+        if job.error:
+            echoerr('VialHttp: {}'.format(job.error))
+            return
+        self.show(self.report(job.result))
+
+    def report(self, results):
+        common = Counter((r.response.status, r.digest) for r, e in results if not e)
+        common = common.most_common(1)[0][0] if common else None
+        columns = ('dns', 'tcp', 'tls', 'write', 'ttfb', 'transfer', 'total')
+
+        rows = []
+        divergent = 0
+        for host, (rctx, error) in zip(self.hosts, results):
+            if error:
+                divergent += 1
+                rows.append('{:<24} ERROR  {}: {}'.format(
+                    host, error.__class__.__name__, error))
+                continue
+
+            status = rctx.response.status
+            mark = ''
+            if (status, rctx.digest) != common:
+                divergent += 1
+                mark = ' *'
+            rows.append('{:<24} {:<6}'.format(host, status) + ''.join(
+                '{:>9}'.format(format_ms(rctx.timings.get(p))) for p in columns) +
+                ' {:>8}  {}{}'.format(sizeof_fmt(rctx.size), rctx.digest, mark))
+
+        lines = ['{} {}'.format(self.method, self.url), '',
+                 'Hosts: {}  Divergent: {}'.format(len(self.hosts), divergent), '',
+                 '{:<24} {:<6}'.format('HOST', 'STATUS') +
+                 ''.join('{:>9}'.format(c.upper()) for c in columns) +
+                 ' {:>8}  {}'.format('SIZE', 'HASH')]
+        return lines + rows
+
+    def show(self, lines):
+        cwin = vim.current.window
+        win, buf = make_scratch('__vial_http_fanout__', title='Fan-out')
+        win.options['statusline'] = 'Fan-out: {}/{} hosts'.format(
+            self.completed, len(self.hosts))
+        buf[:] = lines
+        focus_window(cwin)
+
+
+def bench(total=None, concurrency=None):
+    try:
+        headers, _, method, url, query, body, _, _ = parse_request_at_cursor()
+        producers = prepare_producers(vim.current.buffer, headers, [])
+    except PrepareException as e:
+        echoerr(str(e))
+        return
+
+    source = request_source(vim.current.buffer, vim.current.window.cursor[0] - 1)
+    run_bench(method, url, query, body, headers, total, concurrency, producers, source)
+
+
+def run_bench(method, url, query, body, headers, total=None, concurrency=None,
+              producers=(), source=None):
+    try:
+        total = int(total or headers.pop('Vial-Bench-Requests', BENCH_REQUESTS))
+        concurrency = int(concurrency or headers.pop('Vial-Bench-Concurrency', BENCH_CONCURRENCY))
+    except ValueError as e:
+        echoerr('Invalid bench requests or concurrency: {}'.format(e))
+        return
+    if total < 1 or concurrency < 1:
+        echoerr('Bench requests and concurrency should be positive')
+        return
+
+    headers.pop('Vial-Bench-Requests')
+    headers.pop('Vial-Bench-Concurrency')
+    Bench(method, url, query, body, headers, total, concurrency, producers, source).start()
 
 
 def curl():
@@ -278,12 +1642,35 @@ def curl():
     if opts:
         cmd.append(opts)
 
+    if 'Accept-Encoding' not in headers:
+        cmd.append('--compressed')
+
+    unix_socket = unix_address(host)
+    if unix_socket and unix_socket.startswith('\0'):
+        cmd.extend(['--abstract-unix-socket', cmd_quote(unix_socket[1:])])
+    elif unix_socket:
+        cmd.extend(['--unix-socket', cmd_quote(unix_socket)])
+
     ignored_headers = {it.strip().lower() for it in headers.pop('vial-curl-ignored-headers', '').split(',')}
+    pop_control_headers(headers)
     if headers.get('User-Agent') == 'vial-http':
         ignored_headers.add('user-agent')
 
     form = None
-    if body and headers.get('Content-Type') == 'application/x-www-form-urlencoded':
+    body_file = None
+    if isinstance(body, FileBody):
+        headers.pop('Content-Length')
+        body_file = body.path
+        body = None
+    elif isinstance(body, MultipartBody):
+        headers.pop('Content-Type')
+        headers.pop('Content-Length')
+        for k, v in body.fields:
+            cmd.extend(['-F', cmd_quote('{}={}'.format(k, v))])
+        for k, v in body.files:
+            cmd.extend(['-F', cmd_quote('{}=@{}'.format(k, v['path']))])
+        body = None
+    elif body and headers.get('Content-Type') == 'application/x-www-form-urlencoded':
         headers.pop('Content-Type')
         form = urlparse.parse_qsl(body)
         body = None
@@ -296,7 +1683,9 @@ def curl():
         for k, v in form:
             cmd.extend(['-d', '{}={}'.format(k, urllib.quote_plus(v))])
 
-    if body:
+    if body_file:
+        cmd.extend(['--data-binary', cmd_quote('@' + body_file)])
+    elif body:
         cmd.extend(['--data-binary', '@-'])
 
     cmd.append(cmd_quote(u._replace(path=path).geturl()))
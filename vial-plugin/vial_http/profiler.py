@@ -0,0 +1,101 @@
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+from vial.compat import PY2
+
+if PY2:
+    from cStringIO import StringIO
+else:
+    from io import StringIO
+
+from .connection import ms
+
+PROFILE_STATS_LINES = 40
+
+
+def profile_mode(value):
+    """Returns None, 'stages' or 'cprofile' for a Vial-Profile value"""
+    value = (value or '').strip().lower()
+    if value == 'cprofile':
+        return value
+    if value in ('1', 't', 'true', 'yes'):
+        return 'stages'
+
+
+class Profiler(object):
+    """Records wall time of request execution stages
+
+    Stages are recorded always, they are cheap. :meth:`enable` turns on
+    reporting and, in ``cprofile`` mode, cProfile for a current thread
+    and for calls wrapped with :meth:`wrap`. A main thread profile should
+    be paused while wrapped calls run, python allows only one active
+    profiler.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = []
+        self.mode = None
+        self.profiles = []
+        self.main = None
+
+    def enable(self, mode):
+        self.mode = mode
+        if mode == 'cprofile' and self.main is None:
+            self.main = cProfile.Profile()
+            self.profiles.append(self.main)
+            self.main.enable()
+
+    def pause(self):
+        if self.main is not None:
+            self.main.disable()
+
+    def resume(self):
+        if self.main is not None:
+            self.main.enable()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, ms(start, time.time())))
+
+    def add(self, name, value):
+        self.stages.append((name, value))
+
+    def wrap(self, func):
+        """Profiles func calls in cprofile mode, they can run in other threads"""
+        if self.mode != 'cprofile':
+            return func
+
+        def inner(*args, **kwargs):
+            profile = cProfile.Profile()
+            self.profiles.append(profile)
+            return profile.runcall(func, *args, **kwargs)
+        return inner
+
+    @property
+    def total(self):
+        return ms(self.start, time.time())
+
+    def report(self):
+        """Returns stages table and top cProfile functions by cumulative time"""
+        lines = ['{:<36} {:>9}'.format('STAGE', 'MS')]
+        for name, value in self.stages:
+            if value is not None:
+                lines.append('{:<36} {:>9.1f}'.format(name, value))
+        lines.append('{:<36} {:>9.1f}'.format('total', self.total))
+
+        if self.profiles:
+            out = StringIO()
+            stats = pstats.Stats(self.profiles[0], stream=out)
+            for p in self.profiles[1:]:
+                stats.add(p)
+            stats.sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+            lines.append('')
+            lines.extend(out.getvalue().strip('\n').splitlines())
+
+        return lines
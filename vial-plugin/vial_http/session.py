@@ -0,0 +1,98 @@
+import os
+import re
+import hashlib
+import tempfile
+import threading
+
+from vial.compat import PY2, bstr
+
+if PY2:
+    from cookielib import LWPCookieJar, LoadError
+    from urllib2 import Request
+else:
+    from http.cookiejar import LWPCookieJar, LoadError
+    from urllib.request import Request
+
+from .util import is_true
+
+name_regex = re.compile(r'[^-\w.]+')
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def default_dir():
+    root = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(root, 'vial-http', 'sessions')
+
+
+def session_name(value, source=None):
+    """Returns session name for a `Vial-Session` header value
+
+    True values select a session of a request file, anything else is
+    a named session shared between files.
+    """
+    if is_true(value):
+        if not source or not source[0]:
+            return None
+        fname = os.path.abspath(source[0])
+        digest = hashlib.sha1(bstr(fname, 'utf-8')).hexdigest()[:12]
+        return 'file-{}-{}'.format(name_regex.sub('_', os.path.basename(fname)), digest)
+    return name_regex.sub('_', value.strip()) or None
+
+
+class ResponseInfo(object):
+    """Adapts HTTPResponse to an interface expected by cookiejar"""
+    def __init__(self, response):
+        self.msg = response.msg
+
+    def info(self):
+        return self.msg
+
+
+class Session(object):
+    """Cookie jar persisted into a file in LWP format
+
+    Cookie matching (domain, path, secure flag and expiration) is done
+    by stdlib cookiejar. Session cookies are saved too, so they survive
+    editor restarts.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jar = LWPCookieJar(path)
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self.jar.load(ignore_discard=True)
+            except (LoadError, EnvironmentError):
+                pass
+
+    def cookie_header(self, url):
+        request = Request(url)
+        self.jar.add_cookie_header(request)
+        return request.get_header('Cookie')
+
+    def extract(self, url, response):
+        self.jar.extract_cookies(ResponseInfo(response), Request(url))
+
+    def save(self):
+        with self.lock:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(prefix='.session-', dir=dirname)
+            os.close(fd)
+            try:
+                self.jar.save(tmp, ignore_discard=True)
+                os.rename(tmp, self.path)
+            except EnvironmentError:
+                os.remove(tmp)
+                raise
+
+
+def get_session(name, root=None):
+    path = os.path.join(root or default_dir(), name + '.lwp')
+    with sessions_lock:
+        session = sessions.get(path)
+        if session is None:
+            session = sessions[path] = Session(path)
+        return session
@@ -1,9 +1,34 @@
 from __future__ import print_function
+import os
+import json
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
 from textwrap import dedent
 
 from .util import (parse_request_line, render_template, get_headers_and_templates,
-                   find_request, pretty_xml, StringIO, get_connection_settings,
-                   Headers)
+                   find_request, find_requests, pretty_xml, StringIO, get_connection_settings,
+                   Headers, percentile, histogram, prepare_request, lazy,
+                   pretty_json, iter_pretty_json, iter_pretty_xml, compile_template,
+                   parse_hosts, pop_control_headers, PrepareException)
+from .connection import (ConnectionPool, TimedHTTPConnection, TLSCache, unix_address,
+                         is_stale_error)
+from .document import Document
+from .download import Download, RestartDownload, parse_content_range
+from .multipart import MultipartBody
+from .body import (make_decoder, ResponseBody, LineStream, iter_body,
+                   remove_all_spilled, spilled_files)
+from .pager import Pager, StreamPager
+from .history import History
+from .cache import ResponseCache, get_expires
+from .capture import Capture, capture_connection
+from .session import Session, get_session, session_name
+from .profiler import Profiler, profile_mode
+from .worker import Job, JobList, CancelledError, run_parallel
+from .depends import ProducerCache, find_producer, apply_header_lines, resolve_producers
 
 
 def hdr(**kwargs):
@@ -34,6 +59,7 @@ def test_parse_request_line():
 
     result = parse_request_line('GET /query q=__pwd__', pwd_func=fill)
     assert result['query'] == [('q', '!q')]
+    assert result['secret']
 
     result = parse_request_line('GET /query q=__input__', input_func=fill)
     assert result['query'] == [('q', '!q')]
@@ -44,6 +70,19 @@ def test_parse_request_line():
     assert result['body_from_file'] == '/file'
     assert result['templates'] == ['tpl1']
 
+    result = parse_request_line('GET /export q=value > /tmp/export.csv | tpl1')
+    assert result['query'] == [('q', 'value')]
+    assert result['download_to'] == '/tmp/export.csv'
+    assert result['templates'] == ['tpl1']
+
+    result = parse_request_line('POST /export < /query.json > "/tmp/export 1.csv"')
+    assert result['body_from_file'] == '/query.json'
+    assert result['download_to'] == '/tmp/export 1.csv'
+
+    h = Headers()
+    prepare_request(['GET /query Vial-History:1 q=__pwd__'], 0, h, pwd_func=fill)
+    assert h['Vial-History'] == '0'
+
 
 def test_render_template():
     assert render_template('${body}', body='foo') == 'foo'
@@ -51,6 +90,114 @@ def test_render_template():
     assert render_template('Token: ${json["token"]}', json={}) == "Token: None"
     assert render_template('Token: ${json[token]}', json={}) == "ERROR: name 'token' is not defined"
 
+    calls = []
+    def jdata():
+        calls.append(1)
+        return {'token': 'foo'}
+
+    value = lazy(jdata)
+    assert render_template('${body}', body='foo', json=value) == 'foo'
+    assert not calls
+    assert render_template('${[json[k] for k in ["token"]][0]}', json=value) == 'foo'
+    assert render_template('${json["token"]}', json=value) == 'foo'
+    assert calls == [1]
+
+    assert render_template('${1}', body='foo').startswith('ERROR:')
+    assert render_template('${body +}', body='foo').startswith('ERROR:')
+    assert compile_template('a ${body} b') is compile_template('a ${body} b')
+
+
+def bench_render_template(count=20000):
+    """Prints render_template speed with warm and cold template cache
+
+    python -c 'from vial_http.tests import bench_render_template; bench_render_template()'
+    """
+    from . import util
+    template = ('Authorization: Bearer ${json["token"]}\n'
+                'X-Id: ${json["items"][0]["id"]}\n${set_cookies()}')
+    ctx = {'json': {'token': 't0k', 'items': [{'id': '1'}]},
+           'set_cookies': lambda: 'Cookie: a=b'}
+
+    for name in ('warm', 'cold'):
+        start = time.time()
+        for _ in range(count):
+            if name == 'cold':
+                util.template_cache.clear()
+            render_template(template, **ctx)
+        elapsed = time.time() - start
+        print('{}: {:.0f} renders/s'.format(name, count / elapsed))
+
+
+def test_headers():
+    h = Headers()
+    assert h.headers == [('User-Agent', 'vial-http')]
+    assert Headers([]).headers == [('User-Agent', 'vial-http')]
+
+    h.add('X-Foo', '1')
+    h.add('x-foo', '2')
+    h.set('Host', 'boo.loc')
+    assert h['x-FOO'] == '1'
+    assert h.get('X-Bar') is None
+    assert 'host' in h and 'X-Bar' not in h
+    assert list(h) == ['User-Agent', 'X-Foo', 'x-foo', 'Host']
+
+    h.set('user-agent', 'curl')
+    assert h.items() == [('X-Foo', '1'), ('x-foo', '2'), ('Host', 'boo.loc'),
+                         ('user-agent', 'curl')]
+
+    c = h.copy()
+    assert h.pop('X-FOO') == '2'
+    assert h.pop('X-FOO', 'default') == 'default'
+    assert h.headers == [('Host', 'boo.loc'), ('user-agent', 'curl')]
+    assert c['x-foo'] == '1'
+    assert len(c.headers) == 4
+
+    c.update({'Host': 'foo.loc'})
+    assert h['Host'] == 'boo.loc'
+    assert c.copy('Host').headers == [('User-Agent', 'vial-http'), ('Host', 'foo.loc')]
+
+    for i in range(100):
+        h.set('X-{}'.format(i % 10), str(i))
+    assert len(h.headers) == 12
+    assert h['x-9'] == '99'
+
+    h = Headers([('Host', 'boo.loc'), ('Vial-Hosts', 'a,b'), ('vial-bench-requests', '10'),
+                 ('Vial-Connect', 'unix:/sock'), ('X-Vial', '1')])
+    pop_control_headers(h, ('vial-connect',))
+    assert list(h) == ['Host', 'Vial-Connect', 'X-Vial']
+    pop_control_headers(h)
+    assert list(h) == ['Host', 'X-Vial']
+
+
+def bench_headers(headers=500, requests=500):
+    """Prints header lookup speed for a file with many header lines
+
+    python -c 'from vial_http.tests import bench_headers; bench_headers()'
+    """
+    lines = []
+    for i in range(headers):
+        lines.append('X-Header-{}: {}'.format(i % (headers // 2), i))
+    for i in range(requests):
+        lines.append('GET /path/{}'.format(i))
+        lines.append('X-Header-{}: {}'.format(i % (headers // 2), i))
+    doc = Document(lines)
+
+    start = time.time()
+    for i in range(requests):
+        doc.get_headers_and_templates(headers + i * 2)
+    elapsed = time.time() - start
+    print('get_headers_and_templates: {:.0f} requests/s'.format(requests / elapsed))
+
+    h = doc.get_headers_and_templates(len(lines))[0]
+    start = time.time()
+    for i in range(requests * 100):
+        name = 'X-Header-{}'.format(i % headers)
+        h.get(name)
+        h.set(name, 'value')
+        h.pop('Vial-Timeout')
+    elapsed = time.time() - start
+    print('get/set/pop: {:.0f} ops/s'.format(requests * 300 / elapsed))
+
 
 def test_get_templates():
     content = dedent('''\
@@ -116,6 +263,37 @@ def test_find_request():
     assert find_request(lines, 13) == ('POST /uri5', 'boo', 13)
 
 
+def test_find_requests():
+    content = dedent('''\
+        Host: boo.loc
+        # GET /commented
+
+        POST /uri1
+        boo
+
+        TEMPLATE tpl
+        GET /not-a-request
+
+        TEMPLATE tpl2 << HERE
+        GET /not-a-request
+
+        HERE
+
+        POST /uri2 << HERE
+        boo
+
+        GET /not-a-request
+        HERE
+
+        GET /uri3
+    ''')
+
+    lines = content.splitlines()
+    assert find_requests(lines) == [(3, 4), (14, 18), (20, 20)]
+    assert find_requests(lines, 4, 14) == [(3, 4), (14, 18)]
+    assert find_requests(lines, 5, 13) == []
+
+
 def test_pretty_xml():
     buf = StringIO()
 
@@ -123,11 +301,247 @@ def test_pretty_xml():
         <root xmlns:d='http://boo' xmlns="http://boom">
             <d:child d:foo="boo">some text&gt;<child2 xmlns:foo='http//foo'>text</child2>another text</d:child>
             <d:child>boo</d:child>
-            <d:child>foo</d:child>
-            <d:child>zoo</d:child>
+            <d:child xml:lang="en"><empty/><foo:child xmlns:foo='http//foo2'/></d:child>
             <d:child>hoo</d:child>
         </root>''', buf)
-    print(buf.getvalue())
+    assert buf.getvalue() == dedent('''\
+        <root xmlns:d="http://boo" xmlns="http://boom">
+          <d:child d:foo="boo">some text&gt;<child2 xmlns:foo="http//foo">text</child2>another text</d:child>
+          <d:child>boo</d:child>
+          <d:child xml:lang="en">
+            <empty/>
+            <foo1:child xmlns:foo1="http//foo2"/>
+          </d:child>
+          <d:child>hoo</d:child>
+        </root>''').encode('utf-8')
+
+    page = b'<html><body>\n' + b'<p>Internal Server Error<br>db is down</p>\n' * 50000
+    assert b''.join(iter_pretty_xml(StringIO(page))) == page
+
+    data = b'<root>' + b''.join(u'<item>{}</item>'.format(i).encode('utf-8')
+                                for i in range(5000)) + b'<br></root>'
+    result = b''.join(iter_pretty_xml(StringIO(data)))
+    assert result.startswith(b'<root>\n  <item>0</item>\n')
+    assert b'\nERROR: mismatched tag: line 1, column ' in result
+    assert result.endswith(b', raw body follows\n' + data)
+
+
+def old_pretty_xml(text, out, ident='  '):
+    """Two pass pretty_xml before a streaming rewrite, a baseline for bench_pretty_xml"""
+    from xml.sax.saxutils import quoteattr, escape
+    from collections import Counter
+    from xml.etree import cElementTree as etree
+    from vial.compat import bstr, sstr, ustr
+
+    ns_aliases = {}
+    ns_cache = {}
+    ns_cnt = Counter()
+    def get_alias(tag):
+        try:
+            return ns_cache[tag]
+        except KeyError:
+            pass
+
+        pos = tag.find('}')
+        if pos < 0:
+            result = tag
+        else:
+            rtag = tag[pos+1:]
+            prefix = ns_aliases[tag[1:pos]]
+            result = '{}:{}'.format(prefix, rtag) if prefix else rtag
+
+        ns_cache[tag] = result
+        return result
+
+    buf = StringIO(text)
+    for (event, elem) in etree.iterparse(buf, ('start-ns',)):
+        alias = elem[0]
+        if alias in ns_cnt:
+            if not alias:
+                alias = 'ns'
+
+            falias = alias
+            while falias in ns_cnt:
+                ns_cnt[alias] += 1
+                falias = '{}{}'.format(alias, ns_cnt[alias])
+            alias = falias
+
+        ns_aliases[elem[1]] = alias
+
+    def _render(elem, level, first, use_level):
+        tag = get_alias(elem.tag)
+        attrib = ['{}={}'.format(get_alias(k), sstr(quoteattr(v), 'utf-8'))
+                  for k, v in sorted(elem.attrib.items())]
+        attrib = ustr((' ' + ' '.join(attrib)) if attrib else '', 'utf-8')
+        if first:
+            ns = ' ' + ' '.join('xmlns{}={}'.format((':' + v) if v else v, quoteattr(k))
+                                for k, v in ns_aliases.items())
+        else:
+            ns = ''
+
+        if use_level:
+            nl = '\n' + ident * level
+        else:
+            nl = ''
+
+        txt = elem.text
+        txt = escape(txt) if txt and txt.strip() else ''
+
+        tail = txt
+        has_children = False
+        for child in elem:
+            if not has_children:
+                out.write(u'{}<{}{}{}>{}'.format(nl, tag, ns, attrib, txt).encode('utf-8'))
+            has_children = True
+            _render(child, level+1, False, not tail)
+            tail = child.tail
+            tail = escape(txt) if tail and tail.strip() else ''
+            if tail:
+                out.write(bstr(tail, 'utf-8'))
+
+        if has_children:
+            if not tail:
+                nl = '\n' + ident * level
+            else:
+                nl = ''
+
+            out.write(u'{}</{}>'.format(nl, tag).encode('utf-8'))
+        else:
+            if txt:
+                out.write(u'{}<{}{}{}>{}</{}>'.format(nl, tag, ns, attrib, txt, tag).encode('utf-8'))
+            else:
+                out.write(u'{}<{}{}{}/>'.format(nl, tag, ns, attrib).encode('utf-8'))
+
+        return txt
+
+    buf.seek(0)
+    _render(etree.parse(buf).getroot(), 0, True, False)
+
+
+def bench_pretty_xml(items=50000):
+    """Prints pretty_xml throughput and peak memory on a SOAP-like document
+
+    Compares with :func:`old_pretty_xml`.
+
+    python -c 'from vial_http.tests import bench_pretty_xml; bench_pretty_xml()'
+    """
+    data = b''.join([
+        b'<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+        b'<soap:Body><m:Response xmlns:m="http://example.com/m">'
+    ] + [
+        '<m:item id="{0}"><m:name>name {0} &amp; co</m:name>'
+        '<m:value>{0}</m:value><m:empty/></m:item>'.format(i).encode('utf-8')
+        for i in range(items)
+    ] + [b'</m:Response></soap:Body></soap:Envelope>'])
+
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    size = len(data) / 2.0 ** 20
+    for name, func in (('old', old_pretty_xml), ('new', pretty_xml)):
+        start = time.time()
+        func(data, StringIO())
+        elapsed = time.time() - start
+
+        peak = ''
+        if tracemalloc:
+            tracemalloc.start()
+            func(data, StringIO())
+            peak = ', peak {:.1f}Mb'.format(tracemalloc.get_traced_memory()[1] / 2.0 ** 20)
+            tracemalloc.stop()
+
+        print('{}: {:.1f}Mb in {:.2f}s: {:.1f}Mb/s{}'.format(
+            name, size, elapsed, size / elapsed, peak))
+
+
+def test_pretty_json():
+    data = {'a': [1, 2.5, {}, [], None, True], 'b': {'c': 'str with \\"quotes\\", {[:'},
+            'd': [[{'e': []}]], 'f': '\u0444'}
+    for src in (json.dumps(data), json.dumps(data, indent=4)):
+        buf = StringIO()
+        pretty_json(src.encode('utf-8'), buf)
+        expected = json.dumps(data, indent=2, separators=(',', ': '))
+        assert buf.getvalue().decode('utf-8') == expected
+
+    assert b''.join(iter_pretty_json(b' Internal Server Error: db is down')) == \
+        b' Internal Server Error: db is down'
+    assert b''.join(iter_pretty_json(b'[Errno 5] "failed')) == b'[Errno 5] "failed'
+    assert b''.join(iter_pretty_json(b'{"a": [Errno 5]}')) == b'{\n  "a": [Errno 5]}'
+
+    page = b'<html><body>\n' + b'<p>Internal Server Error: db is down</p>\n' * 50000
+    pager = StreamPager(iter_pretty_json(page))
+    lines = []
+    while not pager.done:
+        lines.extend(pager.next_lines())
+    assert lines == page.splitlines()
+
+
+def test_make_decoder():
+    import gzip
+    import zlib
+    data = b'some data' * 1000
+
+    def decode(encoding, payload):
+        decoder = make_decoder(encoding)
+        chunks = [decoder.decompress(payload[i:i+100]) for i in range(0, len(payload), 100)]
+        return b''.join(chunks) + decoder.flush()
+
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    gzipped = buf.getvalue()
+
+    assert decode('gzip', gzipped) == data
+    assert decode('deflate', zlib.compress(data)) == data
+    assert decode('deflate', zlib.compress(data)[2:-4]) == data
+    assert decode('gzip, deflate', zlib.compress(gzipped)) == data
+    assert make_decoder(None) is None
+    assert make_decoder('identity') is None
+    assert make_decoder('gzip, unknown') is None
+
+
+def test_response_body():
+    body = ResponseBody(10)
+    body.write(b'0123456789')
+    assert not body.spilled
+    assert body.getvalue() == b'0123456789'
+
+    lines = [u'line {}'.format(i).encode('utf-8') for i in range(2500)]
+    for line in lines:
+        body.write(line + b'\n')
+    body.close()
+    content = b'0123456789' + b'\n'.join(lines) + b'\n'
+    assert body.spilled
+    assert body.getvalue() is None
+    assert body.size == len(content)
+    with open(body.path, 'rb') as f:
+        assert f.read() == content
+
+    pager = Pager(body.path)
+    pages = []
+    while not pager.done:
+        pages.append(pager.next_lines())
+    assert [len(r) for r in pages] == [1000, 1000, 500]
+    assert b'\n'.join(sum(pages, [])) + b'\n' == content
+
+    copy = body.copy()
+    path = body.path
+    assert copy.path != path
+    body.discard()
+    assert not os.path.exists(path)
+    assert path not in spilled_files
+    assert copy.read() == content
+
+    other = ResponseBody(0)
+    other.write(b'x')
+    other.close()
+    paths = [copy.path, other.path]
+    assert all(os.path.exists(r) for r in paths)
+    remove_all_spilled()
+    assert not any(os.path.exists(r) for r in paths)
+    assert not spilled_files
 
 
 def test_connection_settings():
@@ -153,3 +567,818 @@ def test_connection_settings():
     result = get_connection_settings('/', hdr(host='https://foo.loc',
                                               **{'vial-connect': 'https://boo.loc:8443'}))
     assert result == (('boo.loc', 8443), ('https', 'foo.loc', '/', '', ''))
+
+    result = get_connection_settings('/', hdr(host='docker',
+                                              **{'vial-connect': 'unix:/run/docker.sock'}))
+    assert result == (('unix:/run/docker.sock', None), ('http', 'docker', '/', '', ''))
+
+    assert unix_address('unix:/run/docker.sock') == '/run/docker.sock'
+    assert unix_address('unix:@uwsgi') == '\0uwsgi'
+    assert unix_address('boo.loc') is None
+
+
+def test_parse_hosts():
+    assert parse_hosts('h1:8080, h2:8080,h3', {}) == ['h1:8080', 'h2:8080', 'h3']
+    templates = {'nodes': 'h1:8080 # primary\n# h2:8080\nunix:/run/app.sock\n'}
+    assert parse_hosts(' @nodes', templates) == ['h1:8080', 'unix:/run/app.sock']
+
+    try:
+        parse_hosts('@missing', templates)
+    except PrepareException as e:
+        assert 'missing' in str(e)
+    else:
+        assert False, 'PrepareException is expected'
+
+
+def test_connection_pool():
+    class Conn(object):
+        def __init__(self):
+            self.sock, self.peer = socket.socketpair()
+
+        def close(self):
+            self.sock.close()
+            self.sock = None
+
+    pool = ConnectionPool(max_per_host=2)
+    assert pool.get('key') is None
+
+    c1, c2, c3 = Conn(), Conn(), Conn()
+    pool.put('key', c1)
+    pool.put('key', c2)
+    pool.put('key', c3)
+    assert c1.sock is None
+
+    c3.peer.close()
+    assert pool.get('key') is c2
+    assert c3.sock is None
+    assert pool.get('key') is None
+
+    pool.idle_timeout = 0
+    pool.put('key', c2)
+    pool.expire()
+    assert not pool.idle
+    assert c2.sock is None
+
+    from errno import EPIPE, ECONNRESET
+    from .connection import httplib
+    assert is_stale_error(socket.error(EPIPE, 'Broken pipe'))
+    assert is_stale_error(socket.error(ECONNRESET, 'Connection reset'))
+    assert is_stale_error(httplib.BadStatusLine(''))
+    assert not is_stale_error(socket.timeout('timed out'))
+
+
+def test_timed_connection():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    try:
+        cn = TimedHTTPConnection('localhost', server.getsockname()[1], timeout=5)
+        cn.connect()
+        assert sorted(cn.timings) == ['dns', 'tcp']
+        assert all(v >= 0 for v in cn.timings.values())
+        cn.close()
+    finally:
+        server.close()
+
+
+def test_capture():
+    c = Capture(4, 4)
+    c.write(b'ab')
+    assert c.getvalue() == b'ab'
+    c.write(b'cdef')
+    assert c.getvalue() == b'abcdef'
+    c.write(b'ghi')
+    assert c.getvalue() == b'abcd\n...TRUNCATED 1 bytes...\nfghi'
+    c.write(b'jk')
+    assert c.getvalue() == b'abcd\n...TRUNCATED 3 bytes...\nhijk'
+    c.write(b'0123456789')
+    assert c.getvalue() == b'abcd\n...TRUNCATED 13 bytes...\n6789'
+    assert c.size == 21
+
+    c = Capture(2, 0)
+    c.write(b'abc')
+    assert c.getvalue() == b'ab'
+
+
+def serve_raw(raw, address=('127.0.0.1', 0)):
+    """Answers a single request with raw bytes
+
+    Listens on a local tcp port or a unix socket if `address` is a string.
+    Returns a bound address and a function to wait for a server shutdown.
+    """
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    server = socket.socket(family, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(1)
+
+    def serve():
+        try:
+            client, _ = server.accept()
+            client.recv(4096)
+            client.sendall(raw)
+            client.close()
+        finally:
+            server.close()
+
+    t = threading.Thread(target=serve)
+    t.start()
+    return server.getsockname(), t.join
+
+
+def test_capture_connection():
+    raw = b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n0123456789'
+    (_, port), join = serve_raw(raw)
+    try:
+        cn = capture_connection(TimedHTTPConnection('localhost', port, timeout=5), 1024, 16)
+        cn.request('GET', '/path', None, {'Host': 'boo.loc'})
+        response = cn.getresponse()
+        assert response.read() == b'0123456789'
+        assert cn.request_capture.getvalue().startswith(b'GET /path HTTP/1.1\r\n')
+        assert cn.response_capture.getvalue() == raw
+        cn.close()
+    finally:
+        join()
+
+
+def test_stream_body():
+    lines = [('event {}'.format(i)).encode() for i in range(1000)]
+    data = b''.join(r + b'\r\n' for r in lines) + b'tail'
+    chunked = b''.join(b'%x\r\n%s\r\n' % (len(data[i:i + 1000]), data[i:i + 1000])
+                       for i in range(0, len(data), 1000))
+    raw = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+           + chunked + b'0\r\n\r\n')
+
+    def fetch(raw, check):
+        (_, port), join = serve_raw(raw)
+        try:
+            cn = TimedHTTPConnection('127.0.0.1', port, timeout=5)
+            cn.request('GET', '/events')
+            response = cn.getresponse()
+            check(response)
+            read = getattr(response, 'read1', response.read)
+            stream = LineStream()
+            body = ResponseBody(1000)
+            result = []
+            for chunk, _ in iter_body(read, size=100):
+                body.write(chunk)
+                stream.append(chunk)
+                result.extend(stream.lines())
+            body.close()
+            result.extend(stream.lines(True))
+            cn.close()
+        finally:
+            join()
+        return result, body
+
+    result, body = fetch(raw, lambda r: r.chunked)
+    assert result == lines + [b'tail']
+    assert body.spilled and body.read() == data
+    assert not LineStream().lines(True)
+
+    stream = LineStream()
+    stream.append(b'stale\npartial')
+    stream.clear()
+    stream.append(b'fresh\n')
+    assert stream.lines(True) == [b'fresh']
+    body.discard()
+
+    # Vial-Stream forces streaming of a plain response
+    raw = 'HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n'.format(len(data)).encode() + data
+    result, body = fetch(raw, lambda r: not r.chunked)
+    assert result == lines + [b'tail']
+    body.discard()
+
+    import zlib
+    payload = zlib.compress(data)
+    chunks = list(iter_body(StringIO(payload).read, make_decoder('deflate'), 100))
+    assert b''.join(r for r, _ in chunks) == data
+    assert sum(r for _, r in chunks) == len(payload)
+
+
+def test_download():
+    from .connection import httplib
+    assert parse_content_range('bytes 10-19/20') == (10, 20)
+    assert parse_content_range('bytes 10-19/*') == (10, None)
+    assert parse_content_range('bytes */20') == (None, 20)
+    assert parse_content_range('items 1-2/3') is None
+    assert parse_content_range(None) is None
+
+    def fetch(download, raw):
+        (_, port), join = serve_raw(raw)
+        try:
+            cn = TimedHTTPConnection('127.0.0.1', port, timeout=5)
+            cn.request('GET', '/file')
+            response = cn.getresponse()
+            assert download.accepts(response)
+            try:
+                download.save(response, 4)
+            finally:
+                cn.close()
+        finally:
+            join()
+
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'file')
+    d = Download(path)
+    assert d.range() is None
+    fetch(d, b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n0123456789')
+    assert read(path) == b'0123456789'
+    assert (d.offset, d.size, d.total) == (0, 10, 10)
+    assert not os.path.exists(d.part)
+
+    # resume from an interrupted download
+    os.remove(path)
+    write(d.part, b'0123')
+    d = Download(path)
+    assert d.range() == 'bytes=4-'
+    fetch(d, b'HTTP/1.1 206 Partial Content\r\nContent-Range: bytes 4-9/10\r\n'
+             b'Content-Length: 6\r\n\r\n456789')
+    assert read(path) == b'0123456789'
+    assert (d.offset, d.size, d.total) == (4, 10, 10)
+
+    # partial content doesn't continue .part file
+    os.remove(path)
+    write(d.part, b'0123')
+    d = Download(path)
+    try:
+        fetch(d, b'HTTP/1.1 206 Partial Content\r\nContent-Range: bytes 2-9/10\r\n'
+                 b'Content-Length: 8\r\n\r\n23456789')
+    except httplib.HTTPException as e:
+        assert 'Content-Range' in str(e)
+    else:
+        assert False, 'HTTPException expected'
+    assert read(d.part) == b'0123'
+    assert not os.path.exists(path)
+
+    # server ignores Range and sends a whole body
+    d = Download(path)
+    fetch(d, b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabcdefghij')
+    assert read(path) == b'abcdefghij'
+    assert (d.offset, d.size) == (0, 10)
+
+    # .part is already complete
+    os.remove(path)
+    write(d.part, b'0123456789')
+    d = Download(path)
+    fetch(d, b'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */10\r\n'
+             b'Content-Length: 0\r\n\r\n')
+    assert read(path) == b'0123456789'
+    assert not os.path.exists(d.part)
+    assert d.size == d.total == 10
+
+    # .part doesn't match, download should be restarted
+    os.remove(path)
+    write(d.part, b'0123456789')
+    d = Download(path)
+    try:
+        fetch(d, b'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */8\r\n'
+                 b'Content-Length: 0\r\n\r\n')
+    except RestartDownload:
+        pass
+    else:
+        assert False, 'RestartDownload expected'
+    assert not os.path.exists(d.part)
+    assert not os.path.exists(path)
+    assert d.range() is None
+    os.rmdir(tmp)
+
+
+def test_session():
+    (_, port), join = serve_raw(b'HTTP/1.1 302 Found\r\n'
+                           b'Set-Cookie: sid=s1; Path=/api\r\n'
+                           b'Set-Cookie: theme=dark; Path=/; Max-Age=3600\r\n'
+                           b'Set-Cookie: foreign=1; Domain=other.loc\r\n'
+                           b'Set-Cookie: gone=1; Max-Age=0\r\n'
+                           b'Content-Length: 0\r\n\r\n')
+    try:
+        cn = TimedHTTPConnection('127.0.0.1', port, timeout=5)
+        cn.request('POST', '/api/login')
+        response = cn.getresponse()
+        response.read()
+        cn.close()
+    finally:
+        join()
+
+    assert session_name('1') is None
+    name = session_name('yes', ('/tmp/api.http', 10))
+    assert name.startswith('file-api.http-')
+    assert name == session_name('1', ('/tmp/api.http', 1))
+    assert session_name('1', ('/tmp/other/api.http', 1)) != name
+    assert session_name('staging / admin') == 'staging_admin'
+
+    root = tempfile.mkdtemp()
+    session = get_session('test', root)
+    assert get_session('test', root) is session
+
+    url = 'http://127.0.0.1:{}/api/login'.format(port)
+    session.extract(url, response)
+    assert session.cookie_header(url) == 'sid=s1; theme=dark'
+    assert session.cookie_header('http://127.0.0.1/') == 'theme=dark'
+    assert session.cookie_header('http://other.loc/') is None
+
+    session.save()
+    restored = Session(os.path.join(root, 'test.lwp'))
+    assert restored.cookie_header(url) == 'sid=s1; theme=dark'
+
+
+def test_unix_connection():
+    raw = b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nunix'
+    tmpdir = tempfile.mkdtemp()
+    addresses = [os.path.join(tmpdir, 'sock')]
+    if sys.platform.startswith('linux'):
+        addresses.append('\0vial-http-test-{}'.format(os.getpid()))
+
+    for address in addresses:
+        _, join = serve_raw(raw, address)
+        try:
+            cn = TimedHTTPConnection('localhost', 80, timeout=5, unix_socket=address)
+            cn.request('GET', '/_ping')
+            response = cn.getresponse()
+            assert response.read() == b'unix'
+            assert list(cn.timings) == ['tcp']
+            cn.close()
+        finally:
+            join()
+
+
+def test_profiler():
+    assert profile_mode('') is None
+    assert profile_mode('1') == 'stages'
+    assert profile_mode('cProfile') == 'cprofile'
+
+    profiler = Profiler()
+    with profiler.stage('parse'):
+        pass
+    profiler.add('network dns', None)
+    profiler.enable('cprofile')
+    profiler.pause()
+    assert profiler.wrap(sum)([1, 2]) == 3
+    assert [r[0] for r in profiler.stages] == ['parse', 'network dns']
+
+    report = profiler.report()
+    assert report[1].startswith('parse ')
+    assert report[2].startswith('total ')
+    assert any('function calls' in r for r in report)
+
+    profiler = Profiler()
+    assert profiler.wrap(sum) is sum
+
+
+def test_producers():
+    doc = Document(dedent('''\
+        TEMPLATE auth
+        Authorization: Bearer ${json["token"]}
+
+        POST /token Vial-Name:login | auth
+
+        GET /me Vial-Depends:login
+    ''').splitlines())
+    assert find_producer(doc, 'login') == 3
+    assert find_producer(doc, 'boo') is None
+
+    h = hdr(Authorization='old')
+    apply_header_lines('Authorization: new\n+X-Trace: 1\nGET /generated', h)
+    assert h.items() == [('Authorization', 'new'), ('X-Trace', '1')]
+
+    cache = ProducerCache()
+    _, templates = doc.get_headers_and_templates(3)
+    cache.put(('t.http', 'login'), {'json': {'token': 't0k'}}, templates, ['auth'],
+              ttl=60, now=1000)
+    entry = cache.get(('t.http', 'login'), now=1059)
+    assert entry.render() == 'Authorization: Bearer t0k'
+
+    # templates are rendered once, lazy values aren't touched later
+    calls = []
+
+    def token():
+        calls.append(1)
+        return {'token': 'l4zy'}
+
+    cache.put(('t.http', 'lazy'), {'json': lazy(token)}, templates, ['auth', 'missing'],
+              now=1000)
+    assert calls == [1]
+    entry = cache.get(('t.http', 'lazy'), now=1001)
+    assert not hasattr(entry, 'ctx')
+    h = hdr()
+    entry.apply(h)
+    entry.apply(h)
+    assert h['Authorization'] == 'Bearer l4zy'
+    assert calls == [1]
+    assert cache.get(('t.http', 'login'), now=1060) is None
+    assert cache.get(('t.http', 'login'), now=1000) is None
+
+
+def test_batch_producers():
+    doc = Document(dedent('''\
+        TEMPLATE auth
+        Authorization: Bearer ${json["token"]}
+
+        POST /token Vial-Name:login | auth
+
+        GET /me Vial-Depends:login
+
+        GET /orders Vial-Depends:login,missing
+
+        POST /refresh Vial-Name:chained Vial-Depends:login | auth
+
+        GET /chained Vial-Depends:chained
+    ''').splitlines())
+
+    def parse(doc, line):
+        headers, templates = doc.get_headers_and_templates(line)
+        return (headers, templates) + prepare_request(doc.lines, line, headers)
+
+    def resolve(line):
+        headers = parse(doc, line)[0]
+        states = []
+        producers = resolve_producers(cache, doc, 't.http', headers.pop('Vial-Depends'),
+                                      headers, states, parse)
+        return headers, states, producers
+
+    # a dependent request before its producer executes the producer itself
+    cache = ProducerCache()
+    headers, states, producers = resolve(5)
+    assert states == []
+    [(name, key, args, templates, tlist)] = producers
+    assert (name, key, tlist) == ('login', ('t.http', 'login'), ['auth'])
+    assert args[:2] == ('POST', '/token') and args[-1] == 3
+    assert 'Authorization' not in headers
+
+    # batch caches a producer context after its stage, next stages use it
+    cache.put(('t.http', 'login'), {'json': {'token': 't0k'}}, templates, tlist)
+    headers, states, producers = resolve(5)
+    assert (states, producers) == ([('login', 'cached')], [])
+    assert headers['Authorization'] == 'Bearer t0k'
+
+    for line, error in ((7, 'missing not found'), (11, 'chained can\'t depend')):
+        try:
+            resolve(line)
+        except PrepareException as e:
+            assert error in str(e)
+        else:
+            assert False, 'PrepareException is expected'
+
+
+def test_tls_cache():
+    cache = TLSCache()
+    ctx = cache.get_context()
+    assert cache.get_context() is ctx
+    assert cache.get_context(verify=True) is not ctx
+
+    cache.put_session(ctx, 'boo.loc', 443, 'session')
+    assert cache.get_session(ctx, 'boo.loc', 443) == 'session'
+    assert cache.get_session(ctx, 'boo.loc', 8443) is None
+    assert cache.get_session(cache.get_context(verify=True), 'boo.loc', 443) is None
+
+
+def test_history():
+    class Response(object):
+        status, reason = 200, 'OK'
+        request = ('boo.loc', 80), 'http://boo.loc/path'
+
+        def getheaders(self):
+            return [('Content-Type', 'text/plain')]
+
+    class Context(object):
+        method = 'GET'
+        raw_request = b'GET /path HTTP/1.1\r\nHost: boo.loc\r\n\r\n'
+        response = Response()
+        timings = {'total': 1.5}
+
+        def __init__(self, content):
+            self.body = ResponseBody(2 ** 20)
+            self.body.write(content)
+            self.size = len(content)
+
+    path = os.path.join(tempfile.mkdtemp(), 'history.sqlite')
+    history = History(path, body_size=100, max_size=500)
+    first = history.add(Context(b'small'), 'boo.http', 1)
+    big = history.add(Context(b'big' * 100), 'boo.http', 5)
+
+    record = history.get(first)
+    assert record['body'] == b'small'
+    assert record['headers'] == [['Content-Type', 'text/plain']]
+    assert history.get(big)['body'] is None
+    with open(history.get(big)['body_path'], 'rb') as f:
+        assert f.read() == b'big' * 100
+
+    assert [r['id'] for r in history.for_source('boo.http', 5)] == [big]
+    assert [r['id'] for r in history.for_url('http://boo.loc/')] == [big, first]
+    assert history.for_url('http://boo.loc/other') == []
+
+    body_path = history.get(big)['body_path']
+    last = history.add(Context(b'last' * 50), 'boo.http', 1)
+    history.evict()
+    assert [r['id'] for r in history.latest()] == [last]
+    assert not os.path.exists(body_path)
+
+    history.evict(time.time() + history.max_age + 1)
+    assert history.latest() == []
+
+    history = History(path, body_size=100, max_size=2000)
+    ids = [history.add(Context(b'x' * 10), 'boo.http', i) for i in range(3)]
+    history.db.execute('UPDATE requests SET time = 0 WHERE id = ?', (ids[0],))
+    history.db.commit()
+    history.close()
+
+    history = History(path, body_size=100, max_size=2000)
+    assert [r['id'] for r in history.latest()] == ids[::-1]
+    ids.append(history.add(Context(b'x' * 10), 'boo.http', 3))
+    assert [r['id'] for r in history.latest()] == ids[:0:-1]
+    for i in range(30):
+        history.add(Context(b'x' * 10), 'boo.http', i)
+        total, = history.db.execute('SELECT SUM(stored) FROM requests').fetchone()
+        assert history.total == total <= history.max_size
+
+    ctx = Context(b'{"user": "boo"}')
+    ctx.raw_request = (b'POST /login HTTP/1.1\r\nHost: boo.loc\r\n'
+                       b'authorization: Bearer s3cret\r\nCookie: sid=s3cret\r\n\r\n'
+                       b'Authorization: body is kept')
+    ctx.response = Response()
+    ctx.response.getheaders = lambda: [('Set-Cookie', 'sid=s3cret'), ('X-Id', '1')]
+    history = History(os.path.join(tempfile.mkdtemp(), 'history.sqlite'))
+    record = history.get(history.add(ctx, 'boo.http', 7))
+    assert record['request'] == (b'POST /login HTTP/1.1\r\nHost: boo.loc\r\n'
+                                 b'authorization: <redacted>\r\nCookie: <redacted>\r\n\r\n'
+                                 b'Authorization: body is kept')
+    assert record['headers'] == [['Set-Cookie', '<redacted>'], ['X-Id', '1']]
+
+
+class FakeResponse(object):
+    status, reason, msg = 200, 'OK', None
+
+    def __init__(self, **headers):
+        self.headers = [(k.replace('_', '-'), v) for k, v in headers.items()]
+
+    def getheader(self, name, default=None):
+        return dict((k.lower(), v) for k, v in self.headers).get(name.lower(), default)
+
+    def getheaders(self):
+        return self.headers
+
+
+def test_get_expires():
+    assert get_expires(FakeResponse(Cache_Control='public, max-age=60'), 100) == 160
+    assert get_expires(FakeResponse(Cache_Control='max-age=60', Age='10'), 100) == 150
+    assert get_expires(FakeResponse(Cache_Control='no-cache, max-age=60'), 100) == 100
+    assert get_expires(FakeResponse(Expires='Thu, 01 Jan 1970 00:01:40 GMT',
+                                    Date='Thu, 01 Jan 1970 00:00:40 GMT'), 100) == 160
+    assert get_expires(FakeResponse(ETag='"1"'), 100) == 100
+
+
+def test_response_cache():
+    def body(size):
+        result = ResponseBody(2 ** 20)
+        result.write(b'x' * size)
+        return result
+
+    cache = ResponseCache(size=100)
+    cache.put('a', FakeResponse(ETag='"1"'), body(40), hdr())
+    cache.put('b', FakeResponse(Cache_Control='max-age=60'), body(40), hdr())
+    cache.put('c', FakeResponse(), body(10), hdr())
+    cache.put('d', FakeResponse(ETag='"1"', Cache_Control='no-store'), body(10), hdr())
+    assert list(cache.entries) == ['a', 'b']
+
+    entry = cache.get('a', hdr())
+    assert entry.etag == '"1"' and not entry.fresh
+    assert cache.get('b', hdr()).fresh
+
+    cache.put('e', FakeResponse(ETag='"2"'), body(40), hdr())
+    assert list(cache.entries) == ['b', 'e']
+    assert cache.used == 80
+
+    cache.put('v', FakeResponse(ETag='"3"', Vary='Accept'), body(10), hdr(accept='text/xml'))
+    assert cache.get('v', hdr(accept='text/xml'))
+    assert cache.get('v', hdr(accept='application/json')) is None
+
+    # validators of a first hop must not leak into a redirect target request
+    headers = hdr()
+    hop = cache.get('e', headers).add_validators(headers)
+    assert hop['If-None-Match'] == '"2"'
+    assert 'If-None-Match' not in headers
+    assert 'If-None-Match' not in cache.get('b', headers).add_validators(headers)
+
+
+def test_job():
+    job = Job(lambda a, b: a + b, 1, b=2)
+    progress = []
+    job.on_progress(lambda j: progress.append(j.done))
+    job.on_done(lambda j: progress.append(j.result))
+    job.start().thread.join()
+    assert not job.progress()
+    job.finish()
+    assert progress == [True, 3]
+
+    def fail():
+        raise ValueError('boo')
+
+    job = Job(fail)
+    job.run()
+    assert job.done and job.result is None
+    assert str(job.error) == 'boo'
+
+    calls = []
+    job = Job(fail)
+    job.on_progress(lambda j: calls.append(1))
+    job.on_progress(lambda j: fail())
+    errors = job.progress()
+    assert [str(e) for e in errors] == ['boo']
+    assert not job.progress()
+    assert calls == [1, 1]
+
+
+def test_job_list():
+    jobs = JobList()
+    event = threading.Event()
+    running = jobs.add(Job(event.wait).start())
+    finished = jobs.add(Job(lambda: None))
+    finished.run()
+    cancelled = []
+    running.on_cancel(lambda: cancelled.append(1))
+    running.on_cancel(lambda: 1 / 0)
+
+    assert jobs.running() == [running]
+    assert jobs.pop_finished() == [finished]
+    assert len(jobs) == 1
+
+    assert jobs.cancel() == 1
+    assert running.cancelled and cancelled == [1]
+    event.set()
+    running.thread.join()
+    assert jobs.pop_finished() == [running]
+    assert not len(jobs)
+
+
+def test_run_parallel():
+    def make(i):
+        def func():
+            time.sleep(0.001 * (10 - i))
+            if i == 3:
+                raise ValueError(i)
+            return i
+        return func
+
+    results = run_parallel([make(i) for i in range(10)], 4)
+    assert [r for r, _ in results] == [0, 1, 2, None, 4, 5, 6, 7, 8, 9]
+    assert [str(e) for _, e in results if e] == ['3']
+
+    job = Job(lambda: run_parallel(funcs, 1, lambda: job.cancelled))
+    funcs = [make(0), job.cancel, make(2), make(4)]
+    job.run()
+    assert [r for r, _ in job.result[:2]] == [0, None]
+    assert not any(e for _, e in job.result[:2])
+    assert all(r is None and isinstance(e, CancelledError)
+               for r, e in job.result[2:])
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 90) == 90
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([5], 99) == 5
+    assert percentile([], 50) is None
+
+
+def test_histogram():
+    lines = histogram([1, 1, 2, 10], bins=2, width=4)
+    assert lines == ['      1ms | #### 3', '      6ms | #    1']
+
+
+def test_document():
+    content = dedent('''\
+        Host: boo.loc
+
+        TEMPLATE tpl << HERE
+        foo: foo
+
+        HERE
+
+        POST /uri1 << HERE
+        boo: boo
+
+        HERE
+
+        boo: boo
+        +foo: foo
+        GET /uri2
+        body
+
+        TEMPLATE tpl2
+        bar
+
+        GET /uri3
+    ''')
+    lines = content.splitlines()
+
+    def check(doc, lines):
+        assert doc.find_requests() == find_requests(lines)
+        for i in range(len(lines)):
+            h1, t1 = doc.get_headers_and_templates(i)
+            h2, t2 = get_headers_and_templates(lines, i)
+            assert h1.headers == h2.headers
+            assert t1 == t2
+            assert doc.find_request(i) == find_request(lines, i)
+
+    doc = Document(lines)
+    check(doc, lines)
+
+    lines = lines[:]
+    lines[15] = 'body: body'
+    doc.update(lines)
+    check(doc, lines)
+
+    lines = lines[:5] + lines[6:]
+    doc.update(lines)
+    check(doc, lines)
+
+    lines = lines + ['', 'TEMPLATE tpl << HERE', 'HERE']
+    doc.update(lines)
+    check(doc, lines)
+
+    block = ['GET /uri3']
+    line = lines.index('GET /uri3')
+    assert doc.locate_request(line, block) == line
+
+    doc.update(['', 'GET /uri0'] + lines)
+    assert doc.locate_request(line, block) == line + 2
+
+    doc.update(['GET /uri3', ''] + lines)
+    assert doc.locate_request(line, block) == line + 2
+    assert doc.locate_request(1, block) == 0
+
+    doc.update([l for l in lines if l != 'GET /uri3'])
+    assert doc.locate_request(line, block) is None
+
+
+def test_document_updates():
+    def check(doc, lines):
+        full = Document(lines)
+        for name in ('requests', 'skipped', 'templates', 'heredocs', 'headers', 'header_lines'):
+            assert getattr(doc, name) == getattr(full, name), (name, lines)
+        assert doc.find_requests() == find_requests(lines)
+
+    lines = ['GET /c | t1', 'h: 1', 'TEMPLATE t1 << HERE', '', 'TEMPLATE t2 << HERE', '',
+             'GET /b', 'h: 1', 'PUT /d << END', 'a END b', 'PUT /d << END', 'x', 'k: v',
+             'GET /b', 'x', '# c', '# c', 'PUT /d << END', '# c', 'TEMPLATE t2 << HERE',
+             '', 'GET /c | t1', '', 'GET /e']
+    doc = Document(lines)
+    lines = lines[:]
+    lines[19] = 'GET /c | t1'
+    doc.update(lines)
+    check(doc, lines)
+
+    pool = ['POST /a << HERE', 'GET /b', 'GET /c | t1', 'x', '', '', '', 'HERE',
+            'h: 1', '+h: 2', '# c', 'TEMPLATE t1 << HERE', 'TEMPLATE t2 << HERE',
+            'TEMPLATE u', 'k: v', 'PUT /d << END', 'END', 'a END b']
+    rnd = random.Random(42)
+    for _ in range(500):
+        lines = [rnd.choice(pool) for _ in range(rnd.randint(1, 25))]
+        doc = Document(lines)
+        for _ in range(5):
+            lines = lines[:]
+            op, line = rnd.randint(0, 2), rnd.randint(0, len(lines))
+            if op == 0:
+                lines.insert(line, rnd.choice(pool))
+            elif line < len(lines):
+                if op == 1:
+                    del lines[line]
+                else:
+                    lines[line] = rnd.choice(pool)
+            doc.update(lines, line if rnd.random() < 0.5 else None)
+            check(doc, lines)
+
+
+def test_multipart_body():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'x' * 100000)
+        f.flush()
+
+        body = MultipartBody([('f', 'boo')], [('file', {'filename': 'data', 'path': f.name})],
+                             boundary=b'BOUNDARY')
+        data = b''.join(body)
+        assert len(body) == len(data) == int(body.headers['Content-Length'])
+        assert data.startswith(b'--BOUNDARY\r\nContent-Disposition: form-data; name="f"\r\n\r\nboo\r\n')
+        assert data.endswith(b'x\r\n--BOUNDARY--\r\n')
+        assert body.headers['Content-Type'] == 'multipart/form-data; boundary=BOUNDARY'
+
+
+def test_prepare_request_body_from_file():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'[1, 2]')
+        f.flush()
+
+        h = Headers()
+        _, _, _, body, _, _ = prepare_request(['POST /url < ' + f.name], 0, h)
+        assert body.read() == b'[1, 2]'
+        assert h['Content-Length'] == '6'
+        assert h['Content-Type'] == 'application/json'
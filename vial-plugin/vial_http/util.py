@@ -1,11 +1,12 @@
 import os.path
 import re
+import math
 import shlex
 import json
 
 from xml.etree import cElementTree as etree
 
-from vial.compat import PY2, bstr, filter, sstr, ustr
+from vial.compat import PY2, filter
 
 if PY2:
     import urllib
@@ -18,60 +19,187 @@ else:
     from http import cookies as Cookie
     from io import BytesIO as StringIO
 
-from .multipart import encode_multipart
+from .multipart import MultipartBody
+from .body import FileBody
 
 header_regex = re.compile(r'^\+?[-\w\d]+$')
+request_regex = re.compile(r'^[A-Z]+\s+\S')
+heredoc_regex = re.compile(r'\s+<<\s+(\w+)$')
+JSON_DETECT_SIZE = 2 ** 20
+TEMPLATE_CACHE_SIZE = 512
+
+template_regex = re.compile(r'\$\{(.+?)\}')
+template_cache = {}
+
 value_regex = re.compile(r'^([-_\w\d]+)(:=|@=|=|:)(.+)$')
 
 
 class PrepareException(Exception): pass
 
 
-def get_line(content, pos):
-    return content.count('\n', 0, pos)
+def is_json(content):
+    try:
+        json.loads(content)
+    except ValueError:
+        return False
+    return True
 
 
-def get_heredocs(lines):
-    ball = '\n'.join(lines)
-    result = []
-    hds = re.finditer(r'(?sm)(\s+<<\s+(\w+))$\n(.+?)(\2)', ball)
-    for m in hds:
-        ss = m.start(1)
-        start = get_line(ball, m.start(2))
-        end = get_line(ball, m.start(4))
-        body = m.group(3)
-        if body and body[-1] == '\n':
-            body = body[:-1]
-        result.append((start, end, ball[:ss].splitlines()[start], body))
+def is_true(value):
+    return value.lower() in ('1', 't', 'true', 'yes')
 
-    return result
 
+def iter_heredocs(lines, idx=0, unterminated=None):
+    """Yields (start, end, request line, body) for heredocs after idx line
 
-def find_request(lines, line):
-    for s, e, l, body in get_heredocs(lines):
-        if s <= line <= e:
-            return l, body, e
+    Lines of heredoc starts without an end marker are appended into
+    `unterminated` list if it's passed.
+    """
+    size = len(lines)
+    while idx < size - 1:
+        m = heredoc_regex.search(lines[idx])
+        if m:
+            here = m.group(1)
+            end = idx + 1
+            pos = lines[end].find(here, 1)
+            while pos < 0 and end + 1 < size:
+                end += 1
+                pos = lines[end].find(here)
+
+            if pos >= 0:
+                body = '\n'.join(lines[idx+1:end] + [lines[end][:pos]])
+                if body and body[-1] == '\n':
+                    body = body[:-1]
+                yield idx, end, lines[idx][:m.start()], body
+                idx = end
+            elif unterminated is not None:
+                unterminated.append(idx)
 
+        idx += 1
+
+
+def get_heredocs(lines):
+    return list(iter_heredocs(lines))
+
+
+def find_block(lines, line):
     l = line
     while l > 0:
         lcontent = lines[l-1]
         if not lcontent.strip() or lcontent[0] == '#':
             break
         l -= 1
-        if l <= 0:
-            break
 
     line = l
 
     bodylines = []
-    for l in lines[line+1:]:
-        if not l.strip():
-            break
-        bodylines.append(l)
+    size = len(lines)
+    l = line + 1
+    while l < size and lines[l].strip():
+        bodylines.append(lines[l])
+        l += 1
 
     return lines[line], '\n'.join(bodylines) or None, line + len(bodylines)
 
 
+def find_request(lines, line):
+    for s, e, l, body in iter_heredocs(lines):
+        if s <= line <= e:
+            return l, body, e
+        if s > line:
+            break
+
+    return find_block(lines, line)
+
+
+def skip_block(lines, idx, here=None):
+    """Returns index of a last line of a block started at idx
+
+    Block ends before an empty line or on a line with heredoc marker.
+    """
+    size = len(lines)
+    if here:
+        idx += 1
+        while idx < size and here not in lines[idx]:
+            idx += 1
+        return min(idx, size - 1)
+
+    while idx + 1 < size and lines[idx + 1].strip():
+        idx += 1
+    return idx
+
+
+def iter_requests(lines, idx=0, templates=None):
+    """Yields (request line, last request line) pairs after idx line
+
+    idx should point to a start of a block. (first, last) lines of
+    skipped template blocks are appended into `templates` list if it's
+    passed.
+    """
+    size = len(lines)
+    block_start = True
+    while idx < size:
+        l = lines[idx]
+        if l.startswith('TEMPLATE '):
+            _, sep, here = l.partition('<<')
+            last = skip_block(lines, idx, sep and here.strip())
+            if templates is not None:
+                templates.append((idx, last))
+            idx = last + 1
+            block_start = False
+            continue
+
+        if not l.strip() or l[0] == '#':
+            block_start = True
+            idx += 1
+            continue
+
+        if block_start and request_regex.match(l):
+            m = heredoc_regex.search(l.rstrip())
+            last = skip_block(lines, idx, m and m.group(1))
+            yield idx, last
+            idx = last + 1
+        else:
+            idx += 1
+
+        block_start = False
+
+
+def find_requests(lines, start=0, end=None):
+    """Returns list of (request line, last request line) pairs
+
+    Only requests intersecting with [start, end] lines range are returned.
+    """
+    if end is None:
+        end = len(lines) - 1
+
+    result = []
+    for first, last in iter_requests(lines):
+        if first > end:
+            break
+        if last >= start:
+            result.append((first, last))
+
+    return result
+
+
+_split_cache = {}
+
+
+def split_request_tail(tail):
+    """Memoized shell-like split of a request line tail"""
+    try:
+        return list(_split_cache[tail])
+    except KeyError:
+        pass
+
+    if len(_split_cache) > 1024:
+        _split_cache.clear()
+
+    parts = _split_cache[tail] = tuple(shlex.split(tail, True))
+    return list(parts)
+
+
 def parse_request_line(line, input_func=None, pwd_func=None):
     line = line.rstrip()
 
@@ -92,7 +220,7 @@ def parse_request_line(line, input_func=None, pwd_func=None):
         tail = ''
 
     if tail:
-        parts = shlex.split(tail, True)
+        parts = split_request_tail(tail)
         try:
             pos = parts.index('|')
         except ValueError:
@@ -101,10 +229,12 @@ def parse_request_line(line, input_func=None, pwd_func=None):
             result['templates'] = filter(None, (r.strip() for r in ''.join(parts[pos+1:]).split(',')))
             parts = parts[:pos]
 
-        if len(parts) >= 2:
+        while len(parts) >= 2 and parts[-2] in ('<', '>'):
             if parts[-2] == '<':
                 result['body_from_file'] = parts[-1]
-                parts = parts[:-2]
+            else:
+                result['download_to'] = parts[-1]
+            parts = parts[:-2]
 
         for p in parts:
             m = value_regex.match(p)
@@ -113,6 +243,7 @@ def parse_request_line(line, input_func=None, pwd_func=None):
 
                 if value == '__pwd__' and pwd_func:
                     value = pwd_func(param)
+                    result['secret'] = True
 
                 if value == '__input__' and input_func:
                     value = input_func(param)
@@ -129,29 +260,37 @@ def parse_request_line(line, input_func=None, pwd_func=None):
     return result
 
 
-def prepare_request(lines, line, headers, input_func=None, pwd_func=None):
-    rline, body, rend  = find_request(lines, line)
+def prepare_request(lines, line, headers, input_func=None, pwd_func=None, request=None):
+    rline, body, rend = request or find_request(lines, line)
     raw = parse_request_line(rline, input_func, pwd_func)
     if not raw:
         raise PrepareException('Invalid format: METHOD uri [qs_param=value] [form_param:=value] [file_param@=value] '
-                               '[Header:value] [< /filename-with-body] [| tpl1,tpl2] [<< HEREDOC]')
+                               '[Header:value] [< /filename-with-body] [> /download-path] '
+                               '[| tpl1,tpl2] [<< HEREDOC]')
 
     headers.update(raw['headers'])
+    if 'download_to' in raw:
+        headers.set('Vial-Download', raw['download_to'])
+
+    if raw.get('secret'):
+        headers.set('Vial-History', '0')
 
     if body is None and 'body_from_file' in raw:
         try:
-            with open(raw['body_from_file']) as f:
-                body = f.read()
+            body = FileBody(raw['body_from_file'])
         except Exception as e:
             raise PrepareException('Can\'t open body file {}: {}'.format(raw['body_from_file'], e))
+        headers.update(body.headers)
 
-    if (body and 'content-type' not in headers
-            and (body[:1000].lstrip() or ' ')[0] in '{['):
-        try:
-            json.loads(body)
-        except ValueError:
-            pass
+    if body and 'content-type' not in headers:
+        if isinstance(body, FileBody):
+            looks_json = (body.prefix(1000).lstrip() or b' ')[:1] in (b'{', b'[')
+            if looks_json and len(body) <= JSON_DETECT_SIZE:
+                looks_json = is_json(body.read())
         else:
+            looks_json = (body[:1000].lstrip() or ' ')[0] in '{[' and is_json(body)
+
+        if looks_json:
             headers.set('Content-Type', 'application/json')
 
     if body is None and (raw['files'] or headers.get('Content-Type') == 'multipart/form-data'):
@@ -159,13 +298,13 @@ def prepare_request(lines, line, headers, input_func=None, pwd_func=None):
         for k, v in raw['files']:
             fname = os.path.basename(v)
             try:
-                with open(v, 'rb') as f:
-                    content = f.read()
+                with open(v, 'rb'):
+                    pass
             except Exception as e:
                 raise PrepareException('Error opening file param {}: {}'.format(v, e))
-            files.append((k, {'filename': fname, 'content': content}))
-        body, h = encode_multipart(raw['form'], files)
-        headers.update(h)
+            files.append((k, {'filename': fname, 'path': v}))
+        body = MultipartBody(raw['form'], files)
+        headers.update(body.headers)
 
     if body is None and raw['form']:
         body = urllib.urlencode(raw['form'])
@@ -174,58 +313,91 @@ def prepare_request(lines, line, headers, input_func=None, pwd_func=None):
     return raw['method'], raw['url'], raw['query'], body, raw.get('templates', []), rend
 
 
-def send_collector(connection):
-    connection._sdata = b''
-    oldsend = connection.send
-    def send(data):
-        if len(connection._sdata) <= 65536:
-            connection._sdata += data
-            if len(connection._sdata) > 65536:
-                connection._sdata += b'\n...TRUNCATED...'
-        return oldsend(data)
-    connection.send = send
-    return connection
+class Headers(object):
+    """Ordered case-insensitive multidict of headers
 
+    Keeps positions of items by a lowercased name, so lookups, `set` and
+    `pop` don't scan all headers. Removed items leave holes which are
+    compacted lazily. Copies share storage until a first modification.
+    """
+    __slots__ = ('_items', '_index', '_holes', '_shared')
 
-class Headers(object):
     def __init__(self, headers=None):
-        self.headers = headers or [('User-Agent', 'vial-http')]
+        self._items = []
+        self._index = {}
+        self._holes = 0
+        self._shared = False
+        for h, v in headers or [('User-Agent', 'vial-http')]:
+            self.add(h, v)
+
+    @property
+    def headers(self):
+        if self._holes:
+            self._compact()
+        return self._items
+
+    @headers.setter
+    def headers(self, headers):
+        self.__init__(headers)
+
+    def _own(self):
+        if self._shared:
+            self._items = list(self._items)
+            self._index = dict(self._index)
+            self._shared = False
+
+    def _compact(self):
+        self._items = items = [r for r in self._items if r is not None]
+        self._index = index = {}
+        for i, (h, _) in enumerate(items):
+            key = h.lower()
+            index[key] = index.get(key, ()) + (i,)
+        self._holes = 0
+        self._shared = False
 
     def set(self, header, value):
-        self.headers = [r for r in self.headers if r[0].lower() != header.lower()]
-        self.headers.append((header, value))
+        self.pop(header)
+        self.add(header, value)
 
     def get(self, name, default=None):
-        try:
-            return self[name]
-        except KeyError:
-            return default
+        positions = self._index.get(name.lower())
+        if positions:
+            return self._items[positions[0]][1]
+        return default
 
     def __getitem__(self, name):
-        result = [r[1] for r in self.headers if r[0].lower() == name.lower()]
-        if not result:
+        positions = self._index.get(name.lower())
+        if not positions:
             raise KeyError(name)
-        return result[0]
+        return self._items[positions[0]][1]
 
     def update(self, headers):
         for k, v in headers.items():
             self.set(k, v)
 
     def add(self, header, value):
-        self.headers.append((header, value))
+        self._own()
+        key = header.lower()
+        self._index[key] = self._index.get(key, ()) + (len(self._items),)
+        self._items.append((header, value))
 
     def __contains__(self, header):
-        return any(h.lower() == header.lower() for h, _ in self.headers)
+        return header.lower() in self._index
 
     def pop(self, header, default=None):
-        result = default
-        headers = []
-        for h, v in self.headers:
-            if h.lower() == header.lower():
-                result = v
-            else:
-                headers.append((h, v))
-        self.headers = headers
+        key = header.lower()
+        if key not in self._index:
+            return default
+
+        self._own()
+        positions = self._index.pop(key)
+        items = self._items
+        result = items[positions[-1]][1]
+        for i in positions:
+            items[i] = None
+        self._holes += len(positions)
+        if self._holes > 32 and self._holes * 2 > len(items):
+            self._compact()
         return result
 
     def iteritems(self):
@@ -238,34 +410,47 @@ class Headers(object):
         return (h for h, _ in self.headers)
 
     def copy(self, *names):
-        result = Headers()
-        for name in names:
-            v = self.get(name)
-            if v is not None:
-                result.set(name, v)
+        """Returns a copy with only given names or a full copy without names"""
+        if names:
+            result = Headers()
+            for name in names:
+                v = self.get(name)
+                if v is not None:
+                    result.set(name, v)
+            return result
+
+        result = Headers.__new__(Headers)
+        result._items = self._items
+        result._index = self._index
+        result._holes = self._holes
+        result._shared = self._shared = True
         return result
 
 
-def get_headers_and_templates(lines, line):
-    headers = Headers()
-    templates = {}
-    it = iter(lines[:line])
-    while True:
-        l = next(it, None)
-        if l is None:
-            break
+def iter_headers_and_templates(lines, idx=0, end=None):
+    """Yields (kind, start, end, name, value) entries after idx line
+
+    kind is 'set' or 'add' for headers and 'template' for templates,
+    `end` is a last line of an entry. Lines after `end` are ignored.
+    """
+    if end is None:
+        end = len(lines)
+    else:
+        end = min(end, len(lines))
 
+    while idx < end:
+        l = lines[idx]
+        start = idx
+        idx += 1
         if l.startswith('TEMPLATE '):
             name, sep, here = l[len('TEMPLATE '):].strip().partition('<<')
             name = name.strip()
             here = here.strip()
 
             tlines = []
-            while True:
-                l = next(it, None)
-                if l is None:
-                    break
-
+            while idx < end:
+                l = lines[idx]
+                idx += 1
                 if sep:
                     pos = l.find(here)
                     if pos == 0:
@@ -276,7 +461,7 @@ def get_headers_and_templates(lines, line):
                 elif not l.strip():
                     break
                 tlines.append(l)
-            templates[name] ='\n'.join(tlines)
+            yield 'template', start, idx - 1, name, '\n'.join(tlines)
         else:
             try:
                 header, value = l.split(':', 1)
@@ -285,35 +470,212 @@ def get_headers_and_templates(lines, line):
 
             if header_regex.match(header):
                 if header[0] == '+':
-                    headers.add(header[1:], value.strip())
+                    yield 'add', start, start, header[1:], value.strip()
                 else:
-                    headers.set(header, value.strip())
+                    yield 'set', start, start, header, value.strip()
+
+
+def get_headers_and_templates(lines, line):
+    headers = Headers()
+    templates = {}
+    for kind, _, _, name, value in iter_headers_and_templates(lines, 0, line):
+        if kind == 'template':
+            templates[name] = value
+        elif kind == 'add':
+            headers.add(name, value)
+        else:
+            headers.set(name, value)
 
     return headers, templates
 
 
-def render_template(template, **ctx):
-    def sub(match):
+class lazy(object):
+    """Template context value computed on a first access"""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self):
         try:
-            return eval(match.group(1), ctx, ctx)
-        except KeyError:
-            return "None"
+            return self.value
+        except AttributeError:
+            pass
+        self.value = self.func()
+        return self.value
+
+
+def code_names(code):
+    """Returns all names referenced by a code object and nested ones"""
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if hasattr(c, 'co_names'):
+            names.update(code_names(c))
+    return names
+
+
+def compile_template(template):
+    """Returns template parts: literal strings and (code, names) pairs
+
+    Parts are cached by template text, placeholders are compiled once.
+    """
+    try:
+        return template_cache[template]
+    except KeyError:
+        pass
+
+    parts = []
+    pos = 0
+    for m in template_regex.finditer(template):
+        if m.start() > pos:
+            parts.append(template[pos:m.start()])
+        code = compile(m.group(1), '<string>', 'eval')
+        parts.append((code, tuple(code_names(code))))
+        pos = m.end()
+
+    if pos < len(template):
+        parts.append(template[pos:])
+
+    if len(template_cache) >= TEMPLATE_CACHE_SIZE:
+        template_cache.clear()
+    template_cache[template] = parts
+    return parts
+
+
+def render_template(template, **ctx):
     try:
-        return re.sub(r'\$\{(.+?)\}', sub, template)
+        result = []
+        for part in compile_template(template):
+            if type(part) is tuple:
+                code, names = part
+                for name in names:
+                    if isinstance(ctx.get(name), lazy):
+                        ctx[name] = ctx[name]()
+                try:
+                    part = eval(code, ctx, ctx)
+                except KeyError:
+                    part = "None"
+            result.append(part)
+        return ''.join(result)
     except Exception as e:
         return 'ERROR: {}'.format(e)
 
 
-def pretty_xml(text, out, ident='  '):
+# the last group matches anything which isn't a json token
+json_token_regex = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]'
+                              br'|(?:true|false|null|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)(?![^\s{}\[\],:"])'
+                              br'|([^\s{}\[\],:"]+|")')
+JSON_CLOSE = {b'{': b'}', b'[': b']'}
+JSON_RAW_CHUNK = 2 ** 16
+
+
+def iter_pretty_json(data, ident=b'  '):
+    """Yields indented json text chunks
+
+    Works on token level without building an object tree, so data can
+    be a bytes string or a memory map of any size. Keys are not sorted.
+    Data is yielded as is from a first token which isn't json, whole
+    data if nothing was formatted before it.
+    """
+    level = 0
+    result = []
+    opened = None
+    flushed = False
+    raw = None
+    for m in json_token_regex.finditer(data):
+        if m.lastindex:
+            if result or flushed:
+                raw = m.start()
+            else:
+                raw = 0
+                opened = None
+            break
+
+        tok = m.group()
+        c = tok[:1]
+        if opened:
+            if tok == JSON_CLOSE[opened]:
+                result.append(opened + tok)
+                opened = None
+                continue
+            level += 1
+            result.append(opened + b'\n' + ident * level)
+            opened = None
+
+        if c == b'{' or c == b'[':
+            opened = c
+        elif c == b'}' or c == b']':
+            level = max(level - 1, 0)
+            result.append(b'\n' + ident * level + tok)
+        elif c == b',':
+            result.append(b',\n' + ident * level)
+        elif c == b':':
+            result.append(b': ')
+        else:
+            result.append(tok)
+
+        if len(result) > 4096:
+            yield b''.join(result)
+            result = []
+            flushed = True
+
+    if opened:
+        result.append(opened)
+
+    if result:
+        yield b''.join(result)
+
+    if raw is not None:
+        for pos in range(raw, len(data), JSON_RAW_CHUNK):
+            yield data[pos:pos + JSON_RAW_CHUNK]
+
+
+def pretty_json(data, out, ident=b'  '):
+    for chunk in iter_pretty_json(data, ident):
+        out.write(chunk)
+
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+XML_RAW_CHUNK = 2 ** 16
+
+
+def iter_pretty_xml(source, ident='  '):
+    """Yields indented xml utf-8 chunks
+
+    Single iterparse pass. Elements are written as soon as their content
+    is known and released after that, so memory doesn't depend on a
+    document size. Namespaces are declared on the same elements as in
+    a source, conflicting prefixes get a numeric suffix.
+
+    Source should be seekable, on a parse error it's yielded as is.
+    Already formatted part can't be taken back, so if there is one,
+    whole source follows an error line.
+    """
+    flushed = False
+    try:
+        for chunk in _iter_pretty_xml(source, ident):
+            yield chunk
+            flushed = True
+    except etree.ParseError as e:
+        if flushed:
+            yield u'\nERROR: {}, raw body follows\n'.format(e).encode('utf-8')
+        source.seek(0)
+        for chunk in iter(lambda: source.read(XML_RAW_CHUNK), b''):
+            yield chunk
+
+
+def _iter_pretty_xml(source, ident):
     from xml.sax.saxutils import quoteattr, escape
-    from collections import Counter
 
-    ns_aliases = {}
-    ns_cache = {}
-    ns_cnt = Counter()
-    def get_alias(tag):
+    aliases = {XML_NAMESPACE: 'xml'}
+    used = set(aliases.values())
+    names = {}
+    pending_ns = []
+    stack = []
+    result = []
+    prev = None
+
+    def qname(tag):
         try:
-            return ns_cache[tag]
+            return names[tag]
         except KeyError:
             pass
 
@@ -321,76 +683,131 @@ def pretty_xml(text, out, ident='  '):
         if pos < 0:
             result = tag
         else:
-            rtag = tag[pos+1:]
-            prefix = ns_aliases[tag[1:pos]]
-            result = '{}:{}'.format(prefix, rtag) if prefix else rtag
+            prefix = aliases[tag[1:pos]]
+            result = '{}:{}'.format(prefix, tag[pos+1:]) if prefix else tag[pos+1:]
 
-        ns_cache[tag] = result
+        names[tag] = result
         return result
 
-    buf = StringIO(text)
-    for (event, elem) in etree.iterparse(buf, ('start-ns',)):
-        alias = elem[0]
-        if alias in ns_cnt:
-            if not alias:
-                alias = 'ns'
-
-            falias = alias
-            while falias in ns_cnt:
-                ns_cnt[alias] += 1
-                falias = '{}{}'.format(alias, ns_cnt[alias])
-            alias = falias
-
-        ns_aliases[elem[1]] = alias
-
-    def _render(elem, level, first, use_level):
-        tag = get_alias(elem.tag)
-        attrib = ['{}={}'.format(get_alias(k), sstr(quoteattr(v), 'utf-8'))
-                  for k, v in sorted(elem.attrib.items())]
-        attrib = ustr((' ' + ' '.join(attrib)) if attrib else '', 'utf-8')
-        if first:
-            ns = ' ' + ' '.join('xmlns{}={}'.format((':' + v) if v else v, quoteattr(k))
-                                for k, v in ns_aliases.items())
-        else:
-            ns = ''
+    def declare(prefix, uri):
+        alias = aliases.get(uri)
+        if alias is None:
+            alias = prefix
+            cnt = 0
+            while alias in used:
+                cnt += 1
+                alias = '{}{}'.format(prefix or 'ns', cnt)
+            aliases[uri] = alias
+            used.add(alias)
+        return ' xmlns{}={}'.format(':' + alias if alias else '', quoteattr(uri))
+
+    def open_tag(elem, name, nl, ns):
+        if elem.attrib:
+            ns += ''.join(' {}={}'.format(qname(k), quoteattr(v))
+                          for k, v in sorted(elem.attrib.items()))
+        return u'{}<{}{}'.format(nl, name, ns)
+
+    append = result.append
+    for event, elem in etree.iterparse(source, ('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            pending_ns.append(elem)
+            continue
+
+        if prev is not None:
+            # tail of a previous sibling is known only at a next event
+            parent = stack[-1]
+            tail = prev.tail
+            if tail and tail.strip():
+                append(escape(tail))
+                parent[5] = True
+            else:
+                parent[5] = False
+            parent[0].remove(prev)
+            prev.clear()
+            prev = None
 
-        if use_level:
-            nl = '\n' + ident * level
-        else:
+        if event == 'start':
             nl = ''
-
-        txt = elem.text
-        txt = escape(txt) if txt and txt.strip() else ''
-
-        tail = txt
-        has_children = False
-        for child in elem:
-            if not has_children:
-                out.write(u'{}<{}{}{}>{}'.format(nl, tag, ns, attrib, txt).encode('utf-8'))
-            has_children = True
-            _render(child, level+1, False, not tail)
-            tail = child.tail
-            tail = escape(txt) if tail and tail.strip() else ''
-            if tail:
-                out.write(bstr(tail, 'utf-8'))
-
-        if has_children:
-            if not tail:
-                nl = '\n' + ident * level
+            if stack:
+                parent = stack[-1]
+                if not parent[4]:
+                    txt = parent[0].text
+                    txt = escape(txt) if txt and txt.strip() else ''
+                    append(open_tag(*parent[:4]) + u'>' + txt)
+                    parent[4] = True
+                    parent[5] = bool(txt)
+                if not parent[5]:
+                    nl = u'\n' + ident * len(stack)
+
+            if pending_ns:
+                ns = ''.join(declare(*r) for r in pending_ns)
+                pending_ns = []
             else:
-                nl = ''
+                ns = ''
 
-            out.write(u'{}</{}>'.format(nl, tag, txt).encode('utf-8'))
+            tag = elem.tag
+            name = names[tag] if tag in names else qname(tag)
+            # elem, name, nl, ns, opened, mixed
+            stack.append([elem, name, nl, ns, False, False])
         else:
-            if txt:
-                out.write(u'{}<{}{}{}>{}</{}>'.format(nl, tag, ns, attrib, txt, tag).encode('utf-8'))
+            entry = stack.pop()
+            if entry[4]:
+                append((u'</' if entry[5] else u'\n' + ident * len(stack) + u'</') + entry[1] + u'>')
             else:
-                out.write(u'{}<{}{}{}/>'.format(nl, tag, ns, attrib, txt).encode('utf-8'))
+                txt = elem.text
+                if txt and txt.strip():
+                    append(u'{}>{}</{}>'.format(open_tag(*entry[:4]), escape(txt), entry[1]))
+                else:
+                    append(open_tag(*entry[:4]) + u'/>')
+
+            if stack:
+                prev = elem
+            else:
+                elem.clear()
+
+            if len(result) > 4096:
+                yield u''.join(result).encode('utf-8')
+                del result[:]
+
+    if result:
+        yield u''.join(result).encode('utf-8')
 
-        return txt
 
-    buf.seek(0)
-    _render(etree.parse(buf).getroot(), 0, True, False)
+def pretty_xml(text, out, ident='  '):
+    """Writes indented xml, text is a bytes string or a file-like object
+
+    Raises ParseError for invalid xml.
+    """
+    source = StringIO(text) if isinstance(text, bytes) else text
+    for chunk in _iter_pretty_xml(source, ident):
+        out.write(chunk)
+
+
+def percentile(values, p):
+    """Returns p-th percentile of sorted values using nearest rank"""
+    if not values:
+        return None
+    idx = int(math.ceil(len(values) * p / 100.0)) - 1
+    return values[max(0, min(idx, len(values) - 1))]
+
+
+def histogram(values, bins=10, width=40):
+    """Returns text histogram lines for a list of millisecond values"""
+    if not values:
+        return []
+
+    lo, hi = min(values), max(values)
+    step = max(1, int(math.ceil((hi - lo + 1) / float(bins))))
+    counts = [0] * bins
+    for v in values:
+        counts[min((v - lo) // step, bins - 1)] += 1
+
+    top = max(counts)
+    result = []
+    for i, c in enumerate(counts):
+        bar = '#' * int(round(c * width / float(top)))
+        result.append('{:>7}ms | {:<{}} {}'.format(lo + i * step, bar, width, c))
+    return result
 
 
 def get_connection_settings(url, headers):
@@ -402,6 +819,9 @@ def get_connection_settings(url, headers):
         u = urlparse.urlsplit(host + url)
 
     vconnect = headers.pop('vial-connect', None)
+    if vconnect and vconnect.startswith('unix:'):
+        return (vconnect, None), u
+
     if vconnect:
         if not vconnect.startswith('http://') and not vconnect.startswith('https://'):
             vconnect = 'http://' + vconnect
@@ -411,6 +831,32 @@ def get_connection_settings(url, headers):
     return (u.hostname, u.port), u
 
 
+def pop_control_headers(headers, keep=()):
+    """Removes Vial-* special headers except lowercased `keep` names
+
+    Special headers are never sent to a server, even ones like Vial-Hosts
+    or Vial-Bench-Requests which a current runner doesn't handle.
+    """
+    for name in [h for h in headers if h.lower().startswith('vial-')]:
+        if name.lower() not in keep:
+            headers.pop(name)
+
+
+def parse_hosts(value, templates):
+    """Returns target hosts from a Vial-Hosts value
+
+    Hosts are separated by commas or whitespace, ``@name`` takes them
+    from a template, one or more hosts per line, ``#`` starts a comment.
+    """
+    value = value.strip()
+    if value.startswith('@'):
+        name = value[1:]
+        if name not in templates:
+            raise PrepareException('Hosts template {} not found'.format(name))
+        value = '\n'.join(r.split('#', 1)[0] for r in templates[name].splitlines())
+    return [r for r in re.split(r'[\s,]+', value) if r]
+
+
 class CookieJar(object):
     def __init__(self):
         self.cookies = Cookie.SimpleCookie()
@@ -0,0 +1,146 @@
+import sys
+import threading
+
+
+class CancelledError(Exception): pass
+
+
+class Job(object):
+    """Runs a function in a background daemon thread
+
+    Job doesn't touch vim at all. Main thread should poll :attr:`done`
+    and call :meth:`finish` to invoke a callback with a result.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self.callbacks = []
+        self.progress_handlers = []
+        self.cancel_handlers = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()[1]
+        finally:
+            self.done = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def on_done(self, callback):
+        self.callbacks.append(callback)
+        return self
+
+    def on_progress(self, handler):
+        self.progress_handlers.append(handler)
+        return self
+
+    def on_cancel(self, handler):
+        self.cancel_handlers.append(handler)
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+        for h in self.cancel_handlers:
+            try:
+                h()
+            except Exception:
+                pass
+
+    def progress(self):
+        """Calls progress handlers, returns list of raised exceptions
+
+        A failed handler is removed, so it doesn't fail on every poll.
+        """
+        errors = []
+        for h in self.progress_handlers[:]:
+            try:
+                h(self)
+            except Exception:
+                self.progress_handlers.remove(h)
+                errors.append(sys.exc_info()[1])
+        return errors
+
+    def finish(self):
+        for cb in self.callbacks:
+            cb(self)
+
+
+def run_parallel(funcs, concurrency, cancelled=None):
+    """Calls funcs using at most `concurrency` threads
+
+    Returns list of (result, error) pairs in funcs order. Pending funcs
+    are not called after `cancelled()` returns true, they get
+    CancelledError instead.
+    """
+    results = [None] * len(funcs)
+    it = iter(enumerate(funcs))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                item = next(it, None)
+            if item is None:
+                return
+
+            idx, func = item
+            if cancelled and cancelled():
+                results[idx] = None, CancelledError()
+                continue
+
+            try:
+                results[idx] = func(), None
+            except Exception:
+                results[idx] = None, sys.exc_info()[1]
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(concurrency, len(funcs)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+class JobList(object):
+    def __init__(self):
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs.append(job)
+        return job
+
+    def running(self):
+        with self.lock:
+            return [r for r in self.jobs if not r.done]
+
+    def pop_finished(self):
+        with self.lock:
+            done = [r for r in self.jobs if r.done]
+            self.jobs = [r for r in self.jobs if not r.done]
+        return done
+
+    def cancel(self):
+        with self.lock:
+            jobs = self.jobs[:]
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def __len__(self):
+        return len(self.jobs)